@@ -0,0 +1,310 @@
+#!/usr/bin/python
+# Benchmark
+# Synthesizes a large organization's Config-* files, runs every generator against them with
+# local fakes standing in for AWS, and reports wall time, peak memory and output bytes per phase.
+# Compare against a saved baseline to catch regressions in consolidation or the builders.
+#
+#   python buildspec/benchmark.py --scopes 500 --users 2000 --environments 6
+#   python buildspec/benchmark.py --save-baseline
+import json
+import os
+import random
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+BUILDSPEC_FOLDER = os.path.dirname(os.path.abspath(__file__))
+ROOT_FOLDER = os.path.dirname(BUILDSPEC_FOLDER)
+PHASES = ['scopes', 'users', 'keys', 'pipelines', 'main']
+METRICS = ['Seconds', 'PeakMemoryMb', 'OutputBytes']
+
+# Local stand in for botocore's client event hooks, enough for instrumentation to count calls
+class FakeEvents():
+
+    def __init__(self):
+        self.handlers = []
+
+    def register_first(self, event_name, handler):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, service, operation):
+        for event_name in ['before-call', 'before-send']:
+            for registered_name, handler in self.handlers:
+                if registered_name == event_name:
+                    handler(event_name + '.' + service + '.' + operation)
+
+# Local stand in for the CloudFormation and IAM clients used by the generators
+class FakeClient():
+
+    def __init__(self, service, scopes):
+        self.service = service
+        self.scopes = scopes
+        self.meta = type('Meta', (), { 'events': FakeEvents() })()
+
+    # Fire the events a real client would for one attempt of an operation
+    def call(self, operation):
+        self.meta.events.emit(self.service, operation)
+
+    def list_stack_resources(self, StackName, NextToken=None):
+        self.call('ListStackResources')
+        return {
+            'StackResourceSummaries': [
+                {
+                    'LogicalResourceId': scope,
+                    'PhysicalResourceId': 'arn:aws:cloudformation:us-east-1:012345678910:stack/' + scope,
+                    'ResourceType': 'AWS::CloudFormation::Stack'
+                } for scope in self.scopes
+            ]
+        }
+
+    def describe_stacks(self, StackName):
+        self.call('DescribeStacks')
+        scope = StackName.split('/')[-1]
+        return {
+            'Stacks': [
+                {
+                    'StackId': StackName,
+                    'StackName': scope,
+                    'StackStatus': 'UPDATE_COMPLETE',
+                    'LastUpdatedTime': '2024-01-01T00:00:00Z',
+                    'Outputs': [
+                        { 'OutputKey': 'S3BucketName', 'OutputValue': 'cicd-main-' + scope.lower() },
+                        { 'OutputKey': 'KmsKeyArn', 'OutputValue': 'arn:aws:kms:us-east-1:012345678910:key/' + scope }
+                    ],
+                    'Parameters': [
+                        { 'ParameterKey': 'AllEnvironmentsCreated', 'ParameterValue': 'True' }
+                    ]
+                }
+            ]
+        }
+
+    def get_paginator(self, operation_name):
+        client = self
+        class Paginator():
+            def paginate(self, **kwargs):
+                yield getattr(client, operation_name)(**kwargs)
+        return Paginator()
+
+    def get_policy(self, PolicyArn):
+        self.call('GetPolicy')
+        return { 'Policy': { 'DefaultVersionId': 'v1' } }
+
+    def get_policy_version(self, PolicyArn, VersionId):
+        self.call('GetPolicyVersion')
+        return {
+            'PolicyVersion': {
+                'Document': {
+                    'Statement': [
+                        { 'Effect': 'Allow', 'Action': ['ec2:Describe*'], 'Resource': '*' }
+                    ]
+                }
+            }
+        }
+
+# Synthesize Config-* files for an organization of the given size
+def generate_configs(args):
+    r = random.Random(args.seed)
+    policy_names = sorted(
+        os.path.relpath(os.path.join(root, filename), 'policies')[:-len('.template')]
+        for root, dirs, files in os.walk('policies') for filename in files
+    )
+    scoped = [name for name in policy_names if name.startswith('scoped/')]
+    other = [name for name in policy_names if name.startswith('wildcard/') or name.startswith('managed/')]
+
+    environments = {
+        'SsoAccount': { 'AccountId': '012345678910' },
+        'WorkloadAccounts': [ { 'Name': 'Cicd', 'Type': 'CICD', 'AccountId': '012345678910' } ] + [
+            { 'Name': 'Env' + str(i), 'Type': 'SDLC', 'AccountId': str(100000000000 + i) } for i in range(1, args.environments)
+        ]
+    }
+    environment_names = [env['Name'] for env in environments['WorkloadAccounts']]
+
+    scopes = {}
+    scope_names = ['Scope' + str(i).zfill(4) for i in range(args.scopes)]
+    for scope in scope_names:
+        policies = { 'Default': r.sample(scoped, r.randint(3, 12)) }
+        if r.random() < 0.1:
+            policies['Default'] = ['scoped/*']
+        for env in r.sample(environment_names, r.randint(0, 2)):
+            policies[env] = r.sample(scoped, r.randint(2, 6)) + r.sample(other, r.randint(0, 2))
+        if r.random() < 0.2:
+            policies['Default'].append(r.choice(scoped) + ':' + r.choice(scope_names))
+        scopes[scope] = {
+            'Policies': policies,
+            'Pipelines': [
+                {
+                    'Name': 'Pipeline' + str(i),
+                    'SourceRepo': 'codecommit:' + scope.lower() + '-' + str(i),
+                    'IncludeCfVars': r.random() < 0.8,
+                    'CicdCodeBuild': r.random() < 0.5,
+                    'CicdCloudFormation': r.random() < 0.5,
+                    'SdlcCodeBuild': r.random() < 0.3,
+                    'SdlcEcs': r.random() < 0.2,
+                    'SdlcEcsClusterName': 'cluster',
+                    'CicdEcrRepo': r.random() < 0.2
+                } for i in range(r.randint(0, 3))
+            ]
+        }
+
+    groups = {}
+    for i in range(args.groups):
+        groups['Group' + str(i)] = {
+            'Scopes': r.sample(scope_names, min(len(scope_names), r.randint(3, 15))),
+            'Policies': { 'Default': [r.choice(['users/ReadOnly', 'users/Admin'])] },
+            'ManagedPolicyArns': { environment_names[-1]: ['arn:aws:iam::aws:policy/ReadOnlyAccess'] }
+        }
+
+    users = {}
+    for i in range(args.users):
+        user = {}
+        if groups and r.random() < 0.8:
+            user['Groups'] = r.sample(sorted(groups), r.randint(1, min(2, len(groups))))
+        if r.random() < 0.5:
+            user['Scopes'] = r.sample(scope_names, min(len(scope_names), r.randint(1, 5)))
+        if r.random() < 0.2:
+            user['Policies'] = { 'Default': [r.choice(scoped) + ':' + r.choice(scope_names)] }
+        if r.random() < 0.1:
+            user['Statements'] = [
+                {
+                    'Sid': 'User' + str(i),
+                    'Effect': 'Allow',
+                    'Action': ['s3:GetObject'],
+                    'Resource': [{ 'Fn::Sub': 'arn:aws:s3:::user-' + str(i) + '/*' }]
+                }
+            ]
+        users['User' + str(i).zfill(5)] = user
+
+    keys = {}
+    for i in range(args.keys):
+        keys['Key' + str(i)] = { 'CICD': r.random() < 0.5, 'SDLC': True }
+
+    for name, contents in [
+        ('Config-Environments', environments),
+        ('Config-Scopes', scopes),
+        ('Config-Groups', groups),
+        ('Config-Users', users),
+        ('Config-Keys', keys)
+    ]:
+        with open(name + '.template', 'w') as f:
+            json.dump(contents, f, indent=4)
+    return scope_names
+
+def folder_size(location):
+    size = 0
+    for root, dirs, files in os.walk(location):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+def run_phase(phase, measure_memory):
+    if phase == 'main':
+        # generate_main_template runs at import
+        run = lambda: runpy.run_path(os.path.join(BUILDSPEC_FOLDER, 'generate_main_template.py'))
+    else:
+        module = __import__({
+            'scopes': 'generate_scope_templates',
+            'users': 'generate_user_templates',
+            'keys': 'generate_key_templates',
+            'pipelines': 'generate_pipeline_templates'
+        }[phase])
+        # Generators parse their own command line, don't hand them the benchmark's
+        run = lambda: module.main([]) if phase == 'scopes' else module.main()
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    peak_memory_mb = None
+    if measure_memory:
+        peak_memory_mb = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+    return {
+        'Seconds': round(seconds, 3),
+        'PeakMemoryMb': peak_memory_mb,
+        'OutputBytes': folder_size(os.path.join('output', phase))
+    }
+
+# Print results, with the change from the baseline if one exists. Returns the largest regression.
+def report(results, baseline):
+    worst = 0
+    print('{:<10} {:>16} {:>16} {:>20}'.format('Phase', *METRICS))
+    for phase, result in results.items():
+        columns = []
+        for metric in METRICS:
+            column = str(result[metric]) if result[metric] is not None else 'n/a'
+            if result[metric] is not None and phase in baseline and baseline[phase].get(metric):
+                change = (result[metric] - baseline[phase][metric]) / baseline[phase][metric]
+                worst = max(worst, change)
+                column += ' ({:+.0%})'.format(change)
+            columns.append(column)
+        print('{:<10} {:>16} {:>16} {:>20}'.format(phase, *columns))
+    return worst
+
+def main():
+    parser = ArgumentParser(description='Benchmark the template generators against a synthetic organization.')
+    parser.add_argument('--scopes', type=int, default=50)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--keys', type=int, default=20)
+    parser.add_argument('--environments', type=int, default=4, help='Number of workload environments, including Cicd.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--phases', nargs='+', choices=PHASES, default=PHASES)
+    parser.add_argument('--no-memory', action='store_true', help='Skip memory tracing, which slows generation down.')
+    parser.add_argument('--baseline', default=os.path.join(os.getcwd(), 'benchmark-baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='Save results as the new baseline.')
+    parser.add_argument('--max-regression', type=float, default=None, help='Exit with an error if any metric grows by more than this ratio (ex: 0.2).')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated build folder.')
+    parser.add_argument('--instrument', action='store_true', help='Print per-phase timings and API call counts for each generator.')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    # Build folder with the repository's policies and templates, and synthetic configs
+    build_folder = tempfile.mkdtemp(prefix='pipes-benchmark-')
+    for folder in ['policies', 'templates']:
+        shutil.copytree(os.path.join(ROOT_FOLDER, folder), os.path.join(build_folder, folder))
+    shutil.copy(os.path.join(ROOT_FOLDER, 'Main.template'), build_folder)
+    cwd = os.getcwd()
+    os.chdir(build_folder)
+    try:
+        scopes = generate_configs(args)
+
+        # Stand in for AWS before the generators import boto3 clients
+        os.environ.setdefault('buildnum', '00001')
+        os.environ.setdefault('Environment', 'cicd')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ['CacheFolder'] = os.path.join(build_folder, '.cache')
+        if args.instrument:
+            os.environ['Instrument'] = 'true'
+        import boto3
+        boto3.client = lambda service, *a, **k: FakeClient(service, scopes)
+        sys.path.insert(0, BUILDSPEC_FOLDER)
+
+        results = {}
+        for phase in args.phases:
+            results[phase] = run_phase(phase, not args.no_memory)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(build_folder)
+        else:
+            print('Build folder: ' + build_folder)
+
+    worst = report(results, baseline)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        print('Saved baseline to ' + args.baseline)
+    if args.max_regression is not None and worst > args.max_regression:
+        print('Regression of {:.0%} exceeds {:.0%}'.format(worst, args.max_regression))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# Bin of packed items, sized as the JSON list it's written out as
+class Bin():
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = []
+        self.indexes = []
+        self.size = 2
+
+    # Size of the bin after adding an item, including the separating comma
+    def size_with(self, item_size):
+        return self.size + item_size + (1 if self.items else 0)
+
+    def add(self, index, item, item_size):
+        self.size = self.size_with(item_size)
+        self.indexes.append(index)
+        self.items.append(item)
+
+    def fill_ratio(self):
+        return self.size / self.capacity
+
+# Pack items into as few bins as possible using first-fit-decreasing.
+# Largest items are placed first, each into the first bin it fits. Bins are returned in
+# the order they were opened with their items in input order, so output is deterministic.
+# An item bigger than the capacity gets a bin of its own.
+def pack(items, item_size, capacity):
+    sizes = [item_size(item) for item in items]
+    # Ties keep input order
+    order = sorted(range(len(items)), key=lambda index: (-sizes[index], index))
+    bins = []
+    for index in order:
+        for b in bins:
+            if b.size_with(sizes[index]) <= capacity:
+                b.add(index, items[index], sizes[index])
+                break
+        else:
+            b = Bin(capacity)
+            b.add(index, items[index], sizes[index])
+            bins.append(b)
+    # Restore input order within each bin
+    for b in bins:
+        b.items = [item for index, item in sorted(zip(b.indexes, b.items), key=lambda pair: pair[0])]
+        b.indexes.sort()
+    return bins
+
+# Summary of how full each bin is (ex: 3 bins: 99%, 97%, 41%)
+def describe_bins(bins):
+    return str(len(bins)) + " bins: " + ", ".join(str(round(b.fill_ratio() * 100)) + "%" for b in bins)
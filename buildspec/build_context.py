@@ -0,0 +1,63 @@
+# Build Context
+# The Config-* files, loaded once per build and indexed for the lookups generators repeat for
+# every user, scope and environment. Treat the contents as read only, they're shared.
+# Files are read and indexes built on first use, so a generator only needs the files it uses
+# (ex: the main template doesn't read Config-Scopes or Config-Groups).
+
+# Configs, read by name (ex: 'scopes') with the loader the context was created with
+CONFIGS = ['environments', 'scopes', 'users', 'groups', 'keys']
+# Indexes, built by the index_<name> method
+INDEXES = ['workload_accounts', 'sso_account_id', 'group_scopes', 'scope_policies', 'user_scopes']
+
+class BuildContext():
+
+    def __init__(self, load_config):
+        self.load_config = load_config
+
+    # Only called for attributes not loaded yet, which are then kept
+    def __getattr__(self, name):
+        if name in CONFIGS:
+            value = self.load_config(name)
+        elif name in INDEXES:
+            value = getattr(self, 'index_' + name)()
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def index_workload_accounts(self):
+        return self.environments['WorkloadAccounts']
+
+    def index_sso_account_id(self):
+        return self.environments['SsoAccount']['AccountId']
+
+    # Group -> scopes
+    def index_group_scopes(self):
+        return {
+            group: group_value.get('Scopes', []) for group, group_value in self.groups.items()
+        }
+
+    # Scope -> Policies, for scopes that have them
+    def index_scope_policies(self):
+        return {
+            scope: scope_value['Policies'] for scope, scope_value in self.scopes.items() if 'Policies' in scope_value
+        }
+
+    # User -> scopes, the user's own followed by their groups'
+    def index_user_scopes(self):
+        return {
+            user: self.get_user_scopes(user_value) for user, user_value in self.users.items()
+        }
+
+    def get_user_scopes(self, user_value):
+        scopes = list(user_value.get('Scopes', []))
+        for group in user_value.get('Groups', []):
+            scopes.extend(self.group_scopes[group])
+        return scopes
+
+    # Policies that apply to an environment, falling back to Default. None if neither is set.
+    @staticmethod
+    def environment_policies(policies, environment):
+        if environment not in policies:
+            environment = 'Default'
+        return policies.get(environment)
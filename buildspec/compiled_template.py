@@ -0,0 +1,78 @@
+# Compiled Template
+# Records where a placeholder (ex: ${Scope}) appears in a JSON value once, so the value can be
+# instantiated for a replacement by copying only the strings, lists and dicts on the way to a
+# placeholder. Everything else is shared with the template, so instances must not be modified.
+# Several placeholders can be compiled together and replaced in one pass. Interned fragments
+# (see fragments.py) are left as they are, they must not contain a placeholder.
+class CompiledTemplate():
+
+    def __init__(self, template, placeholder='${Scope}'):
+        self.template = template
+        self.placeholders = [placeholder] if type(placeholder) is str else list(placeholder)
+        self.plan = self.compile(template)
+
+    def contains_placeholder(self, value):
+        for placeholder in self.placeholders:
+            if placeholder in value:
+                return True
+        return False
+
+    # Build a plan mirroring the template down to each placeholder. None if the value has no placeholder.
+    #  - str: True
+    #  - list: { index: plan }
+    #  - dict: ({ key: plan }, whether any key contains the placeholder)
+    def compile(self, value):
+        if type(value) is str:
+            return True if self.contains_placeholder(value) else None
+        if type(value) is list:
+            plan = {}
+            for index, item in enumerate(value):
+                item_plan = self.compile(item)
+                if item_plan is not None:
+                    plan[index] = item_plan
+            return plan or None
+        if type(value) is dict:
+            plan = {}
+            keys_replaced = False
+            for key, item in value.items():
+                keys_replaced = keys_replaced or self.contains_placeholder(key)
+                item_plan = self.compile(item)
+                if item_plan is not None:
+                    plan[key] = item_plan
+            return (plan, keys_replaced) if plan or keys_replaced else None
+        return None
+
+    def has_placeholder(self):
+        return self.plan is not None
+
+    # Get the template with every placeholder replaced. Takes the replacement of the placeholder,
+    # or with several placeholders, a dict of placeholder -> replacement.
+    def instantiate(self, replacement):
+        if self.plan is None:
+            return self.template
+        replacements = replacement if type(replacement) is dict else { self.placeholders[0]: replacement }
+        return self.apply(self.template, self.plan, replacements)
+
+    def replace(self, value, replacements):
+        for placeholder, replacement in replacements.items():
+            value = value.replace(placeholder, replacement)
+        return value
+
+    def apply(self, value, plan, replacements):
+        if plan is True:
+            return self.replace(value, replacements)
+        if type(value) is list:
+            value = list(value)
+            for index, item_plan in plan.items():
+                value[index] = self.apply(value[index], item_plan, replacements)
+            return value
+        item_plans, keys_replaced = plan
+        if keys_replaced:
+            return {
+                self.replace(key, replacements): self.apply(item, item_plans[key], replacements) if key in item_plans else item
+                for key, item in value.items()
+            }
+        value = dict(value)
+        for key, item_plan in item_plans.items():
+            value[key] = self.apply(value[key], item_plan, replacements)
+        return value
@@ -0,0 +1,488 @@
+import json
+import string
+
+# Max combined size of a merged statement, leaves headroom under IAM's 6144 character policy limit
+MAX_STATEMENT_SIZE = 5900
+
+# Marks a statement whose resources can't be compared by service
+RESOURCES_UNCOMPARABLE = 'Uncomparable'
+
+WHITESPACE = {ord(c): None for c in string.whitespace}
+
+# Calculate number of characters in an object
+def num_characters(o):
+    string_o = json.dumps(o)
+    string_o = string_o.translate(WHITESPACE)
+    return len(string_o)
+
+# Statement that keeps a running count of its size as actions, resources and conditions are appended,
+# so size limit checks don't re-encode the whole statement every time
+class SizedStatement(dict):
+
+    def __init__(self, statement, value_sizes=None):
+        super().__init__(statement)
+        value_sizes = value_sizes or {}
+        self.value_sizes = {
+            key: value_sizes[key] if key in value_sizes else num_characters(value) for key, value in self.items()
+        }
+
+    # Same as num_characters(statement)
+    def size(self):
+        if not self.value_sizes:
+            return 2
+        return 1 + sum(key_size(key) + value_size + 2 for key, value_size in self.value_sizes.items())
+
+    def value_size(self, key):
+        return self.value_sizes[key]
+
+    # Append an item to a list value
+    def append(self, key, item):
+        self.value_sizes[key] += num_characters(item) + (1 if self[key] else 0)
+        self[key].append(item)
+
+    # Recalculate a value's size after changing it in place
+    def refresh(self, key):
+        self.value_sizes[key] = num_characters(self[key])
+
+KEY_SIZES = {}
+
+def key_size(key):
+    if key not in KEY_SIZES:
+        KEY_SIZES[key] = num_characters(key)
+    return KEY_SIZES[key]
+
+# Size of a statement, without re-encoding it if it keeps count of its own size
+def statement_size(statement):
+    if isinstance(statement, SizedStatement):
+        return statement.size()
+    return num_characters(statement)
+
+# Check if an Action or Resource is a wildcard
+def is_wildcard(value):
+    return value == "*" or value == ["*"]
+
+# Hashable form of a JSON value, equal whenever the values are equal
+def freeze(value):
+    if type(value) is dict:
+        return frozenset((key, freeze(item)) for key, item in value.items())
+    if type(value) is list:
+        return tuple(freeze(item) for item in value)
+    return value
+
+# Copy the parts of a statement consolidation appends to
+def copy_statement(statement):
+    statement = dict(statement)
+    for key in ['Action', 'Resource']:
+        if type(statement.get(key)) is list:
+            statement[key] = list(statement[key])
+    if type(statement.get('Condition')) is dict:
+        statement['Condition'] = {
+            condition: {
+                condition_key: list(condition_value) if type(condition_value) is list else condition_value
+                for condition_key, condition_value in condition_content.items()
+            } if type(condition_content) is dict else condition_content
+            for condition, condition_content in statement['Condition'].items()
+        }
+    return statement
+
+# Services of a list of actions (ex: s3:GetObject -> s3)
+def action_services(action):
+    if type(action) is list:
+        return set(item.split(':')[0] for item in action)
+    if len(action) > 0:
+        return { action.split(':')[0] }
+    return set()
+
+# Services a statement's resources can conflict with, in the order they're compared.
+# Comparing stops at the first resource that isn't a Fn::Sub, so nothing after it counts. A resource
+# that can't be parsed is returned as the terminator and only raised if comparing reaches it.
+def resource_services(resource):
+    services = set()
+    try:
+        if len(resource) > 0:
+            if type(resource) is list:
+                for item in resource:
+                    if type(item) is dict:
+                        for key, value in item.items():
+                            if key != "Fn::Sub":
+                                return services, RESOURCES_UNCOMPARABLE
+                            services.add(value.split(':')[2])
+                    else:
+                        services.add(item.split(':')[2])
+            elif type(resource) is dict:
+                for key, value in resource.items():
+                    services.add(value.split(':')[2])
+            else:
+                services.add(resource.split(':')[2])
+    except (AttributeError, IndexError, TypeError) as e:
+        return services, e
+    return services, None
+
+# Service of a single resource within a merged statement, or RESOURCES_UNCOMPARABLE if it isn't a plain Fn::Sub
+def resource_service(resource):
+    service = ""
+    if type(resource) is str:
+        return resource.split(':')[2]
+    for key, value in resource.items():
+        if key != "Fn::Sub" or type(value) is list:
+            return RESOURCES_UNCOMPARABLE
+        service = value.split(':')[2]
+    return service
+
+# Membership index over a list, replacing linear scans when checking for an item or a key/value pair
+class ListIndex():
+
+    def __init__(self, items):
+        self.items = items
+        self.values = set()
+        self.pairs = set()
+        # Fall back to scanning when items can't be indexed the same way they're compared
+        self.scan = type(items) is not list
+        if not self.scan:
+            for item in items:
+                self.index(item)
+
+    def index(self, item):
+        if type(item) is dict:
+            for key, value in item.items():
+                self.pairs.add((key, freeze(value)))
+        else:
+            self.scan = True
+        self.values.add(freeze(item))
+
+    def append(self, item):
+        self.items.append(item)
+        self.add(item)
+
+    # Index an item appended to the list elsewhere
+    def add(self, item):
+        if not self.scan:
+            self.index(item)
+        else:
+            self.values.add(freeze(item))
+
+    def contains(self, item):
+        if type(self.items) is not list:
+            return item in self.items
+        return freeze(item) in self.values
+
+    def contains_pair(self, key, value):
+        if self.scan or value is None:
+            return any(d.get(key, None) == value for d in self.items)
+        return (key, freeze(value)) in self.pairs
+
+# Merge a statement's conditions into a target statement's conditions, skipping values that already exist
+def merge_conditions(target, statement, indexes):
+    merged = False
+    for condition, condition_content in statement['Condition'].items():
+        for condition_key, condition_value in condition_content.items():
+            if (condition, condition_key) not in indexes:
+                indexes[(condition, condition_key)] = ListIndex(target['Condition'][condition][condition_key])
+            index = indexes[(condition, condition_key)]
+            for item in condition_value:
+                if type(item) is dict:
+                    for key, value in item.items():
+                        # Check if key value pair exists in condition_value
+                        if not index.contains_pair(key, value):
+                            # If not, insert it
+                            index.append({key: value})
+                            merged = True
+                # String
+                elif not index.contains(item):
+                    index.append(item)
+                    merged = True
+    return merged
+
+# Merge statements sharing a Sid into a copy of the first, combining resources and conditions
+def merge_sid_statements(statement_list):
+    base_sid_statement = copy_statement(statement_list[0])
+    # Make Resource a list if isn't already
+    if type(base_sid_statement['Resource']) is dict:
+        base_sid_statement['Resource'] = [
+            base_sid_statement['Resource']
+        ]
+    base_sid_statement = SizedStatement(base_sid_statement)
+    resource_index = None
+    condition_indexes = {}
+    for statement in statement_list[1:]:
+        # Add resources to base_sid_statement
+        # If resource wildcard, don't merge resources
+        if not is_wildcard(statement['Resource']):
+            if resource_index is None:
+                resource_index = ListIndex(base_sid_statement['Resource'])
+            # Multiple Resources
+            if type(statement['Resource']) is list:
+                resources = statement['Resource']
+            # Single resource
+            elif type(statement['Resource']) is dict:
+                resources = [statement['Resource']]
+            else:
+                resources = []
+            for resource in resources:
+                # Check if key value pair exist in resources
+                for key, value in resource.items():
+                    if not resource_index.contains_pair(key, value):
+                        base_sid_statement.append('Resource', resource)
+                        resource_index.add(resource)
+        # Add Conditions to base_sid_statement
+        if 'Condition' in statement:
+            if merge_conditions(base_sid_statement, statement, condition_indexes):
+                base_sid_statement.refresh('Condition')
+    return base_sid_statement
+
+# Statement waiting to be merged, with its services and size worked out once
+class CandidateStatement():
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.action_wildcard = is_wildcard(statement['Action'])
+        self.resource_wildcard = is_wildcard(statement['Resource'])
+        self._action_services = None
+        self._resource_services = None
+        self.resource_error = None
+        self._size = None
+
+    def action_services(self):
+        if self._action_services is None:
+            self._action_services = action_services(self.statement['Action'])
+        return self._action_services
+
+    def resource_services(self):
+        if self._resource_services is None:
+            self._resource_services, terminator = resource_services(self.statement['Resource'])
+            if terminator is not RESOURCES_UNCOMPARABLE:
+                self.resource_error = terminator
+        return self._resource_services
+
+    def size(self):
+        if self._size is None:
+            self._size = statement_size(self.statement)
+        return self._size
+
+# Statement built up by consolidation, tracking its services and size as statements merge into it
+class MergedStatement():
+
+    def __init__(self, sid, statement):
+        item = {
+            "Sid": sid,
+            "Effect": statement['Effect'],
+            "Action": list(statement['Action']) if type(statement['Action']) is list else [statement['Action']],
+            "Resource": list(statement['Resource']) if type(statement['Resource']) is list else [statement['Resource']]
+        }
+        if 'Condition' in statement:
+            item['Condition'] = copy_statement(statement)['Condition']
+        # Reuse the sizes of values a consolidated statement already keeps count of
+        value_sizes = {}
+        if isinstance(statement, SizedStatement):
+            value_sizes = {
+                key: statement.value_size(key) for key in ['Effect', 'Action', 'Resource', 'Condition']
+                if key in statement and type(statement[key]) is type(item[key])
+            }
+        self.statement = SizedStatement(item, value_sizes)
+        self.actions = ListIndex(self.statement['Action'])
+        self.condition_indexes = {}
+        self._action_services = None
+        self._resource_services = None
+        self.resource_service_list = []
+        self.resource_terminator = None
+
+    def action_services(self):
+        if self._action_services is None:
+            self._action_services = action_services(self.statement['Action'])
+        return self._action_services
+
+    def resource_services(self):
+        if self._resource_services is None:
+            self._resource_services = set()
+            for resource in self.statement['Resource']:
+                self.add_resource_service(resource)
+        return self._resource_services
+
+    # Services are compared in resource order, so stop at the first resource that can't be compared
+    def add_resource_service(self, resource):
+        if self.resource_terminator is not None:
+            return
+        try:
+            service = resource_service(resource)
+        except (AttributeError, IndexError, TypeError) as e:
+            self.resource_terminator = e
+            return
+        if service == RESOURCES_UNCOMPARABLE:
+            self.resource_terminator = RESOURCES_UNCOMPARABLE
+            return
+        self._resource_services.add(service)
+        self.resource_service_list.append(service)
+
+    # Check if any resource shares a service with the candidate's resources
+    def is_resource_conflict(self, candidate):
+        services = self.resource_services()
+        candidate_services = candidate.resource_services()
+        if candidate.resource_error is None:
+            if not services.isdisjoint(candidate_services):
+                return True
+        # Comparing raises once it reaches the candidate's unparseable resource without a match
+        elif self.resource_service_list:
+            if self.resource_service_list[0] in candidate_services:
+                return True
+            raise candidate.resource_error
+        if self.resource_terminator is not None and self.resource_terminator is not RESOURCES_UNCOMPARABLE:
+            raise self.resource_terminator
+        return self.resource_terminator is RESOURCES_UNCOMPARABLE
+
+    # Checks to see if a candidate statement can be merged into this statement
+    def is_mergable(self, candidate):
+        statement1 = self.statement
+        statement2 = candidate.statement
+        # Effect
+        if statement1['Effect'] != statement2['Effect']:
+            return False
+        # Action
+        # Make sure both are either wildcard or non wildcard
+        action_wildcard = is_wildcard(statement1['Action'])
+        resource_wildcard = is_wildcard(statement1['Resource'])
+        if action_wildcard != candidate.action_wildcard:
+            return False
+        # Can merge actions if wildcard
+        # If resources are wildcard, we don't need to check if actions share a service
+        if not action_wildcard and (not resource_wildcard or not candidate.resource_wildcard):
+            if not self.action_services().isdisjoint(candidate.action_services()):
+                return False
+        # Resource
+        # Make sure both are either wildcard or non wildcard
+        if resource_wildcard != candidate.resource_wildcard:
+            return False
+        if not resource_wildcard and self.is_resource_conflict(candidate):
+            return False
+        # Condition
+        # Make sure conditions either both exist or both don't
+        if ('Condition' in statement1) != ('Condition' in statement2):
+            return False
+        if 'Condition' in statement1:
+            if statement1['Condition'] != statement2['Condition']:
+                return False
+        # Don't combine if statement size is greater than MAX_STATEMENT_SIZE
+        if self.statement.size() + candidate.size() > MAX_STATEMENT_SIZE:
+            return False
+        # Passed
+        return True
+
+    def merge(self, candidate):
+        statement = candidate.statement
+        # Add Resources
+        if not candidate.resource_wildcard:
+            for resource in statement['Resource']:
+                self.statement.append('Resource', resource)
+                if self._resource_services is not None:
+                    self.add_resource_service(resource)
+        # Add Actions
+        if not candidate.action_wildcard:
+            for action in statement['Action']:
+                if not self.actions.contains(action):
+                    self.statement.append('Action', action)
+                    self.actions.add(action)
+                    if self._action_services is not None:
+                        self._action_services.add(action.split(':')[0])
+        # Add Conditions
+        if 'Condition' in statement:
+            if merge_conditions(self.statement, statement, self.condition_indexes):
+                self.statement.refresh('Condition')
+
+# Consolidates a list of statements
+# Input statements are never modified, merged statements are built from copies.
+def consolidate_statements(statements):
+    # Create arrays for each iteration of consolidating
+    statements_merged_sids = []
+    statements_split_size = []
+
+    # Group Similar SID's
+    statement_map = {}
+    for s in statements:
+        # Skip all merging if NotAction or NotResource
+        if 'NotAction' in s or 'NotResource' in s:
+            statements_split_size.append(s)
+        # Skip merging by sids if doesn't exist and add directly to statements_merged_sids list
+        elif 'Sid' not in s:
+            statements_merged_sids.append(s)
+        # Sid exists, add to statement map if doesn't exist
+        else:
+            if s["Sid"] not in statement_map:
+                statement_map[s["Sid"]] = []
+            statement_map[s["Sid"]].append(s)
+    # Loop through SID statements and combine resources
+    for sid, statement_list in statement_map.items():
+        statements_merged_sids.append(merge_sid_statements(statement_list))
+
+    return statements_split_size + merge_statements(statements_merged_sids)
+
+# Consolidates lists of already consolidated statements (ex: a group's and a user's) into one.
+# Sids are generated by consolidation, not shared by related statements, so they aren't merged again.
+def merge_consolidated_statements(blocks):
+    statements_unmergable = []
+    statements = []
+    for block in blocks:
+        for s in block:
+            if 'NotAction' in s or 'NotResource' in s:
+                statements_unmergable.append(s)
+            else:
+                statements.append(s)
+    return statements_unmergable + merge_statements(statements)
+
+# Merge statements sharing a Sid prefix, then split statements that grew too big
+def merge_statements(statements_merged_sids):
+    statements_merged_intelligent = []
+    statements_split_size = []
+
+    # Perform final merge of SIDs
+    # Statements can only merge with statements sharing the same Sid prefix
+    sid_groups = {}
+    for statement in statements_merged_sids:
+        candidate = CandidateStatement(statement)
+        # Create Sid prefix string used for statement
+        sid_effect = statement['Effect']
+        sid_action = "ActWild" if candidate.action_wildcard else "ActScope"
+        sid_resource = "ResWild" if candidate.resource_wildcard else "ResScope"
+        sid_condition = "Cond" if 'Condition' in statement else "NoCond"
+        sid = sid_effect + sid_action + sid_resource + sid_condition
+        # Search for existing statements with matching pattern
+        results = sid_groups.setdefault(sid, [])
+        merged = False
+        for result in results:
+            if result.is_mergable(candidate):
+                result.merge(candidate)
+                merged = True
+                break
+        if not merged:
+            # Add new statement to final list
+            result = MergedStatement(sid + str(len(results)), statement)
+            results.append(result)
+            statements_merged_intelligent.append(result)
+
+    # Split statement actions if too big
+    # Can easily happen on resource wildcards (ex: readonly policies)
+    for result in statements_merged_intelligent:
+        rs = result.statement
+        # Calculate num of splits
+        num_of_split_statements = (rs.value_size('Action') // MAX_STATEMENT_SIZE) + 1
+        # No split needed
+        if num_of_split_statements == 1:
+            statements_split_size.append(rs)
+        # Split needed
+        else:
+            # Calculate desired length of action post split
+            statement_size = (len(rs['Action']) // num_of_split_statements) + 1
+            # Peform split
+            for i in range(0, len(rs['Action']), statement_size):
+                item = {
+                    "Effect": rs['Effect'],
+                    "Resource": rs['Resource'],
+                    "Sid": rs['Sid'] + 'Split' + str(i),
+                    "Action": rs['Action'][i:i + statement_size]
+                }
+                if 'Condition' in rs:
+                    item['Condition'] = rs['Condition']
+                # Effect, Resource and Condition are shared with the unsplit statement, reuse their sizes
+                statements_split_size.append(SizedStatement(item, {
+                    key: rs.value_size(key) for key in ['Effect', 'Resource', 'Condition'] if key in rs
+                }))
+
+    return statements_split_size
@@ -0,0 +1,39 @@
+# Fragments
+# Keeps one shared instance of each structurally identical JSON fragment repeated across templates (ex: a
+# pipeline's ArtifactStore). Interned fragments are frozen, dicts become FrozenDicts and lists tuples, so
+# the shared instance can't be modified through any template holding it. json.dumps writes them like any
+# dict or list, so they're only copied when a template is saved.
+# Interned fragments are kept for the life of the process, only intern fragments that repeat across
+# scopes rather than ones naming a scope.
+
+class FrozenDict(dict):
+
+    def readonly(self, *args, **kwargs):
+        raise TypeError('Interned fragments are shared and must not be modified.')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = readonly
+
+# Key -> interned fragment. A fragment's children are interned first, so their ids stand in for their
+# structure and keys never have to walk more than one level.
+interned_fragments = {}
+
+def item_key(item):
+    if type(item) in (FrozenDict, tuple):
+        return id(item)
+    # True and 1 are equal, but don't serialize the same
+    return (type(item), item)
+
+def fragment_key(value):
+    if type(value) is FrozenDict:
+        return ('dict',) + tuple((key, item_key(item)) for key, item in value.items())
+    return ('list',) + tuple(item_key(item) for item in value)
+
+# Get the shared, frozen instance of a fragment
+def intern_fragment(value):
+    if type(value) in (dict, FrozenDict):
+        value = FrozenDict((key, intern_fragment(item)) for key, item in value.items())
+    elif type(value) in (list, tuple):
+        value = tuple(intern_fragment(item) for item in value)
+    else:
+        return value
+    return interned_fragments.setdefault(fragment_key(value), value)
@@ -8,25 +8,6 @@ import generate_user_templates
 from argparse import ArgumentParser
 from utils import *
 
-def get_cicd_stack_outputs():
-    cf_client = boto3.client('cloudformation')
-    # Get main infra stack resources
-    resource_summaries = cf_client.list_stack_resources(
-        StackName=MAIN_PIPELINE_STACK
-    )['StackResourceSummaries']
-
-    # Get cicd child stack outputs
-    child_stack_outputs = {}
-    # Loop through main infra stack resources
-    for rs in resource_summaries:
-        # Only look for CloudFormation Stacks
-        if rs['ResourceType'] == 'AWS::CloudFormation::Stack':
-            # Get Stack outputs
-            child_stack_outputs[rs['LogicalResourceId']] = cf_client.describe_stacks(
-                StackName = rs['PhysicalResourceId']
-            )['Stacks'][0]['Outputs']
-    return child_stack_outputs
-
 def generate_child_template(template, kmskey, value, environment):
         if environment['Type'] in value and value[environment['Type']] == True:
             template['Resources']['KmsKey' + kmskey] = {
@@ -75,15 +56,37 @@ def generate_child_template(template, kmskey, value, environment):
             }
         return template
 
-def generate_key_templates(environment):
+def generate_key_templates(context, environment, manifest):
     # Open Files
-    kmskeys = read_file(FILE_CONFIG_KEYS)
-    key_parent = read_file('templates/' + FILE_TEMPLATE_KEYS_PARENT)
+    key_parent = read_template(FILE_TEMPLATE_KEYS_PARENT)
 
     # Loop through keys
-    for key, value in kmskeys.items():
+    for key, value in context.keys.items():
         kmskey = key
         
+        # Generate child template unless its inputs are unchanged since the previous build
+        location = OUTPUT_FOLDER + '/keys/' + environment['Name'] + '/' + FILE_TEMPLATE_KEYS_CHILD + '-' + kmskey
+        inputs_hash = hash_inputs({
+            'Code': get_code_version(),
+            'Template': get_template_hash(FILE_TEMPLATE_KEYS_CHILD),
+            'Environment': environment,
+            'Key': kmskey,
+            'Config': value
+        })
+        reused = manifest.is_current(location, inputs_hash)
+        if reused:
+            record_output_file(location)
+        else:
+            with instrumentation.entity('key', kmskey, environment['Name']):
+                # Open child template to insert KMS Keys
+                key_child = read_template(FILE_TEMPLATE_KEYS_CHILD)
+
+                key_child = generate_child_template(key_child, kmskey, value, environment)
+
+                # Save child file
+                write_file(location, key_child)
+        manifest.record(location, inputs_hash, reused)
+
         key_parent['Resources'][kmskey] = {
             "Type" : "AWS::CloudFormation::Stack",
             "Properties": {
@@ -105,28 +108,25 @@ def generate_key_templates(environment):
                     }
                 ],
                 "TemplateURL" : {
-                    "Fn::Sub": "https://s3.amazonaws.com/${S3BucketName}/builds/keys/" + BUILD_NUM + "/" + environment['Name'] + "/Keys-Child-" + kmskey + ".template"
+                    "Fn::Sub": get_template_url('keys', location)
                 }
             }
         }
-        
-        # Open child template to insert KMS Keys
-        key_child = read_file('templates/' + FILE_TEMPLATE_KEYS_CHILD)
-            
-        key_child = generate_child_template(key_child, kmskey, value, environment)
-
-        # Save child file
-        write_file(OUTPUT_FOLDER + '/keys/' + environment['Name'] + '/' + FILE_TEMPLATE_KEYS_CHILD + '-' + kmskey, key_child)
 
     # Save parent file
     write_file(OUTPUT_FOLDER + '/keys/' + environment['Name'] + '/' + FILE_TEMPLATE_KEYS_PARENT, key_parent)
 
 def main():
+    context = load_build_context()
+    manifest = load_manifest('keys')
     # Loop through workload environments
-    environments = read_file(FILE_CONFIG_ENVIRONMENTS)
-    for env in environments['WorkloadAccounts']:
+    for env in context.workload_accounts:
         # Generate key templates
-        generate_key_templates(env)
+        generate_key_templates(context, env, manifest)
+    manifest.save()
+    print('Keys: ' + manifest.summary())
+    finish_output('keys')
+    write_instrumentation_report('keys')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
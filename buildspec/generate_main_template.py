@@ -5,10 +5,11 @@ import json
 from collections import OrderedDict
 from utils import *
 
-environments = read_file(FILE_CONFIG_ENVIRONMENTS)
+context = load_build_context()
+environments = context.environments
 main = read_file(FILE_TEMPLATE_MAIN)
-users = read_file(FILE_CONFIG_USERS)
-kmskeys = read_file(FILE_CONFIG_KEYS)
+users = context.users
+kmskeys = context.keys
     
 base_statement = [
     {
@@ -360,4 +361,5 @@ for env in environments['WorkloadAccounts']:
     run_order += 1
         
 # Save files
-write_file(OUTPUT_FOLDER + '/main/' + FILE_TEMPLATE_MAIN, main)
\ No newline at end of file
+write_file(OUTPUT_FOLDER + '/main/' + FILE_TEMPLATE_MAIN, main)
+write_instrumentation_report('main')
\ No newline at end of file
@@ -8,6 +8,8 @@ import pipeline_builder
 from utils import *
 from collections import OrderedDict
 from botocore.exceptions import ClientError
+from fragments import intern_fragment
+from stack_discovery import get_child_stack_parameters, get_snapshot_location, has_snapshot
 
 # Template Snippets
 assume_role_statement = {
@@ -108,24 +110,15 @@ s3_bucket_statement = {
 }
 
 def get_parameters_of_child_stacks(main_stack_created):
-    client_cloudformation = boto3.client('cloudformation')
     child_stack_parameters = {}
     if main_stack_created:
-        # Get main infra stack resources
-        resource_summaries = client_cloudformation.list_stack_resources(
-            StackName=MAIN_PIPELINE_STACK
-        )['StackResourceSummaries']
         # Get existing child stack parameters
-        # Loop through main infra stack resources
-        for rs in resource_summaries:
-            # Only look for CloudFormation Stacks
-            if rs['ResourceType'] == 'AWS::CloudFormation::Stack':
-                # Get Stack parameters
-                child_stack_parameters[rs['LogicalResourceId']] = client_cloudformation.describe_stacks(
-                    StackName = rs['PhysicalResourceId']
-                )['Stacks'][0]['Parameters']
+        child_stack_parameters = get_child_stack_parameters()
     return child_stack_parameters
 
+# Snippets above with cross account access filled in, shared by every scope
+cross_account_statements = {}
+
 def update_statements_with_crossaccount_permissions(environments):
     # Generate base statement needed for cross-environment access.
     base_statement_all = generate_base_statement(environments, "All")
@@ -136,10 +129,20 @@ def update_statements_with_crossaccount_permissions(environments):
     pass_role_statement['Fn::If'][1]['Resource'] = base_statement_deploy[:]
     kms_key_statement['Fn::If'][1]['Principal']['AWS'] = base_statement_all[:]
     s3_bucket_statement['Fn::If'][1]['Principal']['AWS'] = base_statement_all[:]
+    # Every scope's template shares these, frozen so none can change the others
+    cross_account_statements['AssumeRole'] = intern_fragment(assume_role_statement)
+    cross_account_statements['PassRole'] = intern_fragment(pass_role_statement)
+    cross_account_statements['KmsKey'] = intern_fragment(kms_key_statement)
+    cross_account_statements['S3Bucket'] = intern_fragment(s3_bucket_statement)
 
 # Check if main stack exists
 def main_stack_exists():
-    client_cloudformation = boto3.client('cloudformation')
+    # Offline, it exists if its children were recorded. Without a record there's no telling.
+    if OFFLINE:
+        if not has_snapshot():
+            raise ValueError("Offline builds can't tell whether " + MAIN_PIPELINE_STACK + " exists without a snapshot of its child stacks. Run online once to populate " + get_snapshot_location(MAIN_PIPELINE_STACK) + ".")
+        return True
+    client_cloudformation = create_client('cloudformation')
     exists = True
     try:
         client_cloudformation.describe_stacks(StackName=MAIN_PIPELINE_STACK)
@@ -154,7 +157,7 @@ def are_all_environments_created_for_scope(scope, child_stack_parameters):
     if scope not in child_stack_parameters:
         all_envs_created = False
     if all_envs_created:
-        all_envs_created = list(filter(lambda item: item['ParameterKey'] == 'AllEnvironmentsCreated', child_stack_parameters[scope]))[0]['ParameterValue']
+        all_envs_created = child_stack_parameters[scope].get('AllEnvironmentsCreated', False)
     return all_envs_created
 
 def insert_childstack_into_parentstack(template_scope_parent, scope, all_envs_created):
@@ -183,7 +186,7 @@ def insert_childstack_into_parentstack(template_scope_parent, scope, all_envs_cr
                 }
             ],
             "TemplateURL" : {
-                "Fn::Sub": "https://s3.amazonaws.com/${S3BucketName}/builds/pipelines/" + BUILD_NUM + "/" + FILE_TEMPLATE_PIPELINES_CHILD + "-" + scope + ".template"
+                "Fn::Sub": get_template_url('pipelines', OUTPUT_FOLDER + '/pipelines/' + FILE_TEMPLATE_PIPELINES_CHILD + '-' + scope)
             }
         }
     }
@@ -236,7 +239,7 @@ def generate_base_statement(environments, purpose):
 
 def generate_scoped_pipelines_template(environments, scope, scope_value):
     # Open child template to insert pipelines
-    template_scope_child = read_file('templates/' + FILE_TEMPLATE_PIPELINES_CHILD)
+    template_scope_child = read_template(FILE_TEMPLATE_PIPELINES_CHILD)
 
     #template_scope_child = add_policy_statements(template_scope_child, scope, scope_value, 'Cicd')
 
@@ -254,11 +257,11 @@ def generate_scoped_pipelines_template(environments, scope, scope_value):
     )
 
     # Add cross account policies we created above
-    template_scope_child['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'].append(assume_role_statement)
-    template_scope_child['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'].append(pass_role_statement)
+    template_scope_child['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'].append(cross_account_statements['AssumeRole'])
+    template_scope_child['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'].append(cross_account_statements['PassRole'])
     #template_scope_child['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement'].append(pass_role_statement)
-    template_scope_child['Resources']['KmsKey']['Properties']['KeyPolicy']['Statement'].append(kms_key_statement)
-    template_scope_child['Resources']['S3BucketPolicy']['Properties']['PolicyDocument']['Statement'].append(s3_bucket_statement)
+    template_scope_child['Resources']['KmsKey']['Properties']['KeyPolicy']['Statement'].append(cross_account_statements['KmsKey'])
+    template_scope_child['Resources']['S3BucketPolicy']['Properties']['PolicyDocument']['Statement'].append(cross_account_statements['S3Bucket'])
 
     # Loop through pipelines
     if 'Pipelines' in scope_value:
@@ -294,29 +297,10 @@ def generate_scoped_pipelines_template(environments, scope, scope_value):
                     template_scope_child['Resources']['EcrRepository' + pipeline['Name']]['Properties']['RepositoryPolicyText']['Statement'][0]['Principal']['AWS'].append(
                          "arn:aws:iam::" + env['AccountId'] + ":root"
                     )
-            # Loop through environments and Use Environment Builder
+            # Loop through environments, pipelines with the same settings share each environment's compiled stage
             envs = []
             for env in environments:
-                stage = (pipeline_builder
-                    .EnvironmentBuilder(scope, environments, pipeline, env)
-                        .Cicd()
-                            .CicdCloudFormation()
-                            .Build()
-                            .CicdCodeBuild()
-                            .Build()
-                        .Build()
-                        .Sdlc()
-                            .SdlcCloudFormation()
-                            .Build()
-                            .SdlcEcs()
-                            .Build()
-                            .SdlcCodeBuild()
-                            .Build()
-                        .Build()
-                        .ManualApproval()
-                        .Build()
-                    .Build()
-                )
+                stage = pipeline_builder.build_stage(scope, pipeline, env)
                 if len(stage['Actions']) > 0:
                     envs.append(stage)
             # Use Pipeline Builder with output of enviroment builder
@@ -345,35 +329,37 @@ def generate_scoped_pipelines_template(environments, scope, scope_value):
     write_file(OUTPUT_FOLDER + '/pipelines/' + FILE_TEMPLATE_PIPELINES_CHILD + '-' + scope, template_scope_child)
     return
 
-def generate_scoped_templates(environments):
-    # Check if main stack exists
-    main_stack_created = main_stack_exists()
-    # Get parameters of child stacks
-    # Obviously can't if the main stack doesn't even exist
-    child_stack_parameters = get_parameters_of_child_stacks(main_stack_created)
+def generate_scoped_templates(context):
+    with instrumentation.phase('discovery'):
+        # Check if main stack exists
+        main_stack_created = main_stack_exists()
+        # Get parameters of child stacks
+        # Obviously can't if the main stack doesn't even exist
+        child_stack_parameters = get_parameters_of_child_stacks(main_stack_created)
     # Open files
-    template_scope_parent = read_file('templates/' + FILE_TEMPLATE_PIPELINES_PARENT)
-    scopes = read_file(FILE_CONFIG_SCOPES)
+    template_scope_parent = read_template(FILE_TEMPLATE_PIPELINES_PARENT)
     # Loop through scopes
-    for scope, scope_value in scopes.items():
+    for scope, scope_value in context.scopes.items():
         # Determine if all environments for this scope have been created
         all_envs_created = are_all_environments_created_for_scope(scope, child_stack_parameters)
-        # Insert child stack into parent stack for CICD Scopes
-        template_scope_parent = insert_childstack_into_parentstack(template_scope_parent, scope, all_envs_created)
         # Generate scoped pipelines template
-        generate_scoped_pipelines_template(environments, scope, scope_value)
+        with instrumentation.entity('scope', scope):
+            generate_scoped_pipelines_template(context.workload_accounts, scope, scope_value)
+        # Insert child stack into parent stack for CICD Scopes, after generating it since its TemplateURL may depend on its contents
+        template_scope_parent = insert_childstack_into_parentstack(template_scope_parent, scope, all_envs_created)
     # Save parent file
     write_file(OUTPUT_FOLDER + '/pipelines/' + FILE_TEMPLATE_PIPELINES_PARENT, template_scope_parent)
 
 def main():
-    # Open Environments File
-    environments = read_file(FILE_CONFIG_ENVIRONMENTS)['WorkloadAccounts']
+    context = load_build_context()
 
     # Update cross account policy statements with environments
-    update_statements_with_crossaccount_permissions(environments)
+    update_statements_with_crossaccount_permissions(context.workload_accounts)
 
     # Generate scope templates
-    generate_scoped_templates(environments)
+    generate_scoped_templates(context)
+    finish_output('pipelines')
+    write_instrumentation_report('pipelines')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
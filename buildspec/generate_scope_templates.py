@@ -5,48 +5,66 @@ import os
 import json
 import urllib.parse
 import generate_user_templates
+from parallel import run_parallel
 from argparse import ArgumentParser
 from utils import *
-from botocore.config import Config
+from stack_discovery import get_child_stack_outputs, validate_child_stack_outputs
 
-# Max retry config
-config = Config(
-    retries = dict(
-        max_attempts = 10
+# Hash of everything a scope's child template is generated from
+def get_scope_inputs_hash(scope, scope_value, environment):
+    policies = BuildContext.environment_policies(scope_value.get('Policies', {}), environment['Name']) or []
+    return hash_inputs({
+        'Code': get_code_version(),
+        'Template': get_template_hash(FILE_TEMPLATE_SCOPES_CHILD),
+        'Environment': environment['Name'],
+        'Scope': scope,
+        'Policies': policies,
+        'PolicyInputs': get_policy_inputs([policies])
+    })
+
+def get_scope_template_location(scope, environment):
+    return OUTPUT_FOLDER + '/scopes/' + environment + '/' + FILE_TEMPLATE_SCOPES_CHILD + '-' + scope
+
+def generate_scope_child_template(scope, scope_value, environment, location):
+    # Open child template to insert CodeBuildProjects
+    scope_child = read_template(FILE_TEMPLATE_SCOPES_CHILD)
+
+    scope_child = add_policy_statements(scope_child, scope, scope_value, environment['Name'])
+
+    # Consolidate Policies
+    scope_child['Resources']['IamPolicyService']['Properties']['PolicyDocument']['Statement'] = consolidate_statements(
+        scope_child['Resources']['IamPolicyService']['Properties']['PolicyDocument']['Statement']
     )
-)
-
-def get_cicd_stack_outputs():
-    cf_client = boto3.client('cloudformation', config=config)
-    # Get main infra stack resources
-    resource_summaries = cf_client.list_stack_resources(
-        StackName=MAIN_PIPELINE_STACK
-    )['StackResourceSummaries']
-
-    # Get cicd child stack outputs
-    child_stack_outputs = {}
-    # Loop through main infra stack resources
-    for rs in resource_summaries:
-        # Only look for CloudFormation Stacks
-        if rs['ResourceType'] == 'AWS::CloudFormation::Stack':
-            # Get Stack outputs
-            child_stack_outputs[rs['LogicalResourceId']] = cf_client.describe_stacks(
-                StackName = rs['PhysicalResourceId']
-            )['Stacks'][0]['Outputs']
-    return child_stack_outputs
-
-def generate_scope_templates(environment, child_stack_outputs):
+
+    scope_child['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement'] = consolidate_statements(
+        scope_child['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement']
+    )
+
+    scope_child['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'] = consolidate_statements(
+        scope_child['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement']
+    )
+
+    # Save child file
+    return write_file(location, scope_child)
+
+# Generate one (scope, environment) child template within a worker
+def generate_scope_template_item(item):
+    scope, scope_value, environment = item
+    location = get_scope_template_location(scope, environment['Name'])
+    with instrumentation.entity('scope', scope, environment['Name']):
+        return location, generate_scope_child_template(scope, scope_value, environment, location)
+
+def generate_scope_templates(context, environment, child_stack_outputs):
     # Open Files
-    scopes = read_file(FILE_CONFIG_SCOPES)
-    scope_parent = read_file('templates/' + FILE_TEMPLATE_SCOPES_PARENT)
+    scope_parent = read_template(FILE_TEMPLATE_SCOPES_PARENT)
 
     # Loop through infra scopes within pipeline file
-    for key, value in scopes.items():
+    for key, value in context.scopes.items():
         scope = key
         
         # Determine stack output values
-        s3_bucket_name = list(filter(lambda item: item['OutputKey'] == 'S3BucketName', child_stack_outputs[scope]))[0]['OutputValue']
-        kms_key_arn = list(filter(lambda item: item['OutputKey'] == 'KmsKeyArn', child_stack_outputs[scope]))[0]['OutputValue']
+        s3_bucket_name = child_stack_outputs[scope]['S3BucketName']
+        kms_key_arn = child_stack_outputs[scope]['KmsKeyArn']
         
         scope_parent['Resources'][scope] = {
             "Type" : "AWS::CloudFormation::Stack",
@@ -77,43 +95,52 @@ def generate_scope_templates(environment, child_stack_outputs):
                     }
                 ],
                 "TemplateURL" : {
-                    "Fn::Sub": "https://s3.amazonaws.com/${S3BucketName}/builds/scopes/" + BUILD_NUM + "/" + environment['Name'] + "/Scopes-Child-" + scope + ".template"
+                    "Fn::Sub": get_template_url('scopes', get_scope_template_location(scope, environment['Name']))
                 }
             }
         }
-        
-        # Open child template to insert CodeBuildProjects
-        scope_child = read_file('templates/' + FILE_TEMPLATE_SCOPES_CHILD)
-            
-        scope_child = add_policy_statements(scope_child, scope, value, environment['Name'])
-
-        # Consolidate Policies
-        scope_child['Resources']['IamPolicyService']['Properties']['PolicyDocument']['Statement'] = consolidate_statements(
-            scope_child['Resources']['IamPolicyService']['Properties']['PolicyDocument']['Statement']
-        )
-
-        scope_child['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement'] = consolidate_statements(
-            scope_child['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement']
-        )
-
-        scope_child['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'] = consolidate_statements(
-            scope_child['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement']
-        )
-
-        # Save child file
-        write_file(OUTPUT_FOLDER + '/scopes/' + environment['Name'] + '/' + FILE_TEMPLATE_SCOPES_CHILD + '-' + scope, scope_child)
 
     # Save parent file
     write_file(OUTPUT_FOLDER + '/scopes/' + environment['Name'] + '/' + FILE_TEMPLATE_SCOPES_PARENT, scope_parent)
 
-def main():
+def main(args=None):
+    parser = ArgumentParser(description='Generate scope templates for every workload environment.')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Processes used to generate child templates, 1 to generate serially. Defaults to the Workers setting.')
+    args = parser.parse_args(args)
+
     # Get outputs from cicd child stacks
-    child_stack_outputs = get_cicd_stack_outputs()
+    with instrumentation.phase('discovery'):
+        child_stack_outputs = get_child_stack_outputs()
+
+    context = load_build_context()
+    # Every scope needs its CICD child stack's outputs, check them all before generating anything
+    validate_child_stack_outputs(context.scopes, child_stack_outputs, ['S3BucketName', 'KmsKeyArn'])
+    # Load shared data before workers start, so they inherit it rather than each loading it
+    get_policy_library()
+    get_managed_policy_cache()
+    # Only generate child templates whose inputs changed since the previous build, each (scope, environment) is independent
+    manifest = load_manifest('scopes')
+    items = []
+    for env in context.workload_accounts:
+        for scope, scope_value in context.scopes.items():
+            location = get_scope_template_location(scope, env['Name'])
+            inputs_hash = get_scope_inputs_hash(scope, scope_value, env)
+            reused = manifest.is_current(location, inputs_hash)
+            if reused:
+                record_output_file(location)
+            else:
+                items.append((scope, scope_value, env))
+            manifest.record(location, inputs_hash, reused)
+    for location, changed in run_parallel(generate_scope_template_item, items, args.workers):
+        record_output_file(location, changed)
+    manifest.save()
+    print('Scopes: ' + manifest.summary())
 
-    # Generate scope templates with CICD child stack outputs
-    environments = read_file(FILE_CONFIG_ENVIRONMENTS)
-    for env in environments['WorkloadAccounts']:
-        generate_scope_templates(env, child_stack_outputs)
+    # Generate parent templates with CICD child stack outputs, in Config-Scopes order
+    for env in context.workload_accounts:
+        generate_scope_templates(context, env, child_stack_outputs)
+    finish_output('scopes')
+    write_instrumentation_report('scopes')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -6,6 +6,8 @@ import string
 import os
 import json
 from utils import *
+from bin_packer import pack, describe_bins
+from parallel import run_parallel
 from collections import OrderedDict
 from botocore.exceptions import ClientError
 from argparse import ArgumentParser
@@ -33,68 +35,31 @@ def insert_childstack_into_parentstack(template_users_parent, user, environment)
                 }
             ],
             "TemplateURL" : {
-                "Fn::Sub": "https://s3.amazonaws.com/${S3BucketName}/builds/users/" + BUILD_NUM + "/" + environment + "/" + FILE_TEMPLATE_USERS_CHILD + "-" + user + ".template"
+                "Fn::Sub": get_template_url('users', get_user_template_location(user, environment))
             }
         }
     }
 
-def get_user_scopes(user_value):
-    groups = read_file(FILE_CONFIG_GROUPS)
-    # Add User Scopes
-    scopes = []
-    if 'Scopes' in user_value:
-        for scope in user_value['Scopes']:
-            scopes.append(scope)
-    # Add Group Scopes
-    if 'Groups' in user_value:
-        for group in user_value['Groups']:
-            if 'Scopes' in groups[group]:
-                for group_scope in groups[group]['Scopes']:
-                    scopes.append(group_scope)
-    return scopes
-
-def insert_user_managed_policies(template_user, user_statements):
-    # BinPack user_statements into policies
-    current_bin_num = 0
-    current_bin_size = 0
-    bins = [[]]
-    # Loop through statements
-    for statement in user_statements:
-        # # Create new bin if needed
-        # if len(bins) < current_bin_num + 1:
-        #     bins.append([])
-        # Get size of current statement
-        statement_size = num_characters(statement)
-        # If combined size less than max bin size, append statement, add to current size
-        if statement_size + current_bin_size < 5900:
-            bins[current_bin_num].append(statement)
-            current_bin_size += statement_size
-        else:
-            bins.append([])
-            current_bin_num += 1
-            bins[current_bin_num].append(statement)
-            current_bin_size = statement_size
+def insert_user_managed_policies(template_user, bins):
     iteration = 1
     # Add policies to user template
     for b in bins:
-        # Don't add empty statements
-        if len(b) > 0:
-            template_user['Resources']['IamManagedPolicy' + str(iteration)] = {
-                "Type" : "AWS::IAM::ManagedPolicy",
-                "Properties" : {
-                    "PolicyDocument" : {
-                        "Version":"2012-10-17",
-                        "Statement" : b
-                    },
-                    "Roles" : [ { "Ref": "IamRole"} ]
-                }
+        template_user['Resources']['IamManagedPolicy' + str(iteration)] = {
+            "Type" : "AWS::IAM::ManagedPolicy",
+            "Properties" : {
+                "PolicyDocument" : {
+                    "Version":"2012-10-17",
+                    "Statement" : b.items
+                },
+                "Roles" : [ { "Ref": "IamRole"} ]
             }
+        }
         iteration += 1
     return template_user
 
-def insert_user_into_userstack(template_user, user, user_value, user_statements, environment):
-    groups = read_file(FILE_CONFIG_GROUPS)
-    sso_account_id = read_file(FILE_CONFIG_ENVIRONMENTS)['SsoAccount']['AccountId']
+def insert_user_into_userstack(context, template_user, user, user_value, user_statements, environment):
+    groups = context.groups
+    sso_account_id = context.sso_account_id
     # Only include inline policies if they have statements
     inline_policies = []
     if 'PoliciesInline' in user_value:
@@ -112,8 +77,7 @@ def insert_user_into_userstack(template_user, user, user_value, user_statements,
         }
     ]
 
-    scopes = get_user_scopes(user_value)
-    for scope in scopes:
+    for scope in context.user_scopes[user]:
         tags.append(
             {
                 "Key": "Scope/" + scope,
@@ -149,7 +113,10 @@ def insert_user_into_userstack(template_user, user, user_value, user_statements,
                 "Tags": tags
             }
         }
-    template_user = insert_user_managed_policies(template_user, user_statements)
+    # BinPack user_statements into as few managed policies as possible
+    with instrumentation.phase('packing'):
+        bins = pack(user_statements, statement_size, MAX_MANAGED_POLICY_SIZE)
+    template_user = insert_user_managed_policies(template_user, bins)
     
     # Add ManagedPolicies
     if 'ManagedPolicyArns' in user_value:
@@ -163,113 +130,171 @@ def insert_user_into_userstack(template_user, user, user_value, user_statements,
                     for managedpolicy in groups[group]['ManagedPolicyArns'][environment]:
                         template_user['Resources']['IamRole']['Properties']['ManagedPolicyArns'].append(managedpolicy)
     # Remove ManagedPolicyArn duplicates
-    template_user['Resources']['IamRole']['Properties']['ManagedPolicyArns'] = list(set(template_user['Resources']['IamRole']['Properties']['ManagedPolicyArns']))
+    template_user['Resources']['IamRole']['Properties']['ManagedPolicyArns'] = sorted(set(template_user['Resources']['IamRole']['Properties']['ManagedPolicyArns']))
+    # Report how full each role's generated policies are, warning about roles over the managed policies per role limit
+    num_managed_policies = len(bins) + len(template_user['Resources']['IamRole']['Properties']['ManagedPolicyArns'])
+    if num_managed_policies > MAX_MANAGED_POLICIES_PER_ROLE:
+        print("Warning: " + environment + " role for " + user + " has " + str(num_managed_policies) + " managed policies, more than the limit of " + str(MAX_MANAGED_POLICIES_PER_ROLE) + ". Generated policies: " + describe_bins(bins))
+    else:
+        print(environment + " role for " + user + ": " + str(num_managed_policies) + " managed policies. Generated policies: " + describe_bins(bins))
     return template_user
 
 def add_policy_statements_to_user_policy(policies, user_statements, environment, scope=None):
-    # If environment doesn't exist, set to default
-    if environment not in policies:
-        environment = 'Default'
-    if environment in policies:
-        # First, add scoped/* if exists
-        if 'scoped/*' in policies[environment]:
-            for filename in os.listdir('policies/scoped'):
-                temp = read_file('policies/scoped/' + filename.split('.')[0])
-                # If scope provided, find & replace within policies
-                scope_replaced = json.loads(json.dumps(temp).replace('${Scope}', scope)) if scope else json.loads(json.dumps(temp))
-                if 'UserStatements' in scope_replaced:
-                    for statement in scope_replaced['UserStatements']:
-                        user_statements.append(statement)
-        # Add rest of policies
-        for policy in policies[environment]:
-            if policy != 'scoped/*':
-                # Don't re-add resource-scope policies if already added via wildcard
-                if not policy.startswith('scoped/') or 'scoped/*' not in policies:
-                    # Parse everything before ':' to get file name
-                    policyname_split = policy.split(':')
-                    temp = read_file('policies/' + policyname_split[0])
-                    # If contains alternative scope name, replace scope within file
-                    if len(policyname_split) > 1:
-                        scope = policyname_split[1]
-                    # If scope provided, find & replace within policies
-                    scope_replaced = json.loads(json.dumps(temp).replace('${Scope}', scope)) if scope else json.loads(json.dumps(temp))
-                    if 'UserStatements' in scope_replaced:
-                        for statement in scope_replaced['UserStatements']:
-                            if 'PolicyArn' in statement:
-                                user_statements.extend(get_policy_statements(statement['PolicyArn']))
-                            else:
-                                user_statements.append(statement)
+    # If environment doesn't exist, fall back to default
+    environment_policies = BuildContext.environment_policies(policies, environment)
+    if environment_policies is not None:
+        # If scope provided, find & replace within policies
+        user_statements.extend(resolve_policy_statements(environment_policies, 'UserStatements', scope, True))
+
+def add_scope_statements_to_user_policy(context, scope, user_statements, environment):
+    # Add policies from scopes file, shared with every other user of the scope
+    user_statements.extend(get_scope_statements(context, scope, environment, 'UserStatements'))
 
-def add_scope_statements_to_user_policy(scope, user_statements, environment):
-    # Read Scopes Files
-    scopes = read_file(FILE_CONFIG_SCOPES)
-    # Add policies from scopes file
-    if 'Policies' in scopes[scope]:
-        add_policy_statements_to_user_policy(scopes[scope]['Policies'], user_statements, environment, scope)
+# Consolidated statements of a combination of groups per environment, keyed by (groups, environment)
+group_statements_memo = {}
+
+def generate_group_statements(context, groups, environment):
+    group_statements = []
+    # Add Group Scopes
+    for group in groups:
+        for group_scope in context.group_scopes[group]:
+            add_scope_statements_to_user_policy(context, group_scope, group_statements, environment)
+        if 'Policies' in context.groups[group]:
+            add_policy_statements_to_user_policy(context.groups[group]['Policies'], group_statements, environment)
+    # Minimize Statements
+    return tuple(consolidate_statements(group_statements))
 
-def generate_user_statements(user, user_value, environment):
-    groups = read_file(FILE_CONFIG_GROUPS)
+# Get the consolidated statements of a user's groups, shared by every user in the same groups.
+# A tuple, neither it nor its statements may be modified.
+def get_group_statements(context, groups, environment):
+    key = (groups, environment)
+    if key not in group_statements_memo:
+        group_statements_memo[key] = generate_group_statements(context, groups, environment)
+    return group_statements_memo[key]
+
+def generate_user_statements(context, user, user_value, environment):
+    groups = tuple(user_value.get('Groups', []))
+    group_scopes = set(scope for group in groups for scope in context.group_scopes[group])
     # Loop through scopes attached to user
     user_statements = []
-    # Add User Scopes
+    # Add User Scopes, unless a group already has them
     if 'Scopes' in user_value:
         for scope in user_value['Scopes']:
-            add_scope_statements_to_user_policy(scope, user_statements, environment)
+            if scope not in group_scopes:
+                add_scope_statements_to_user_policy(context, scope, user_statements, environment)
     # Add Policies
     if 'Policies' in user_value:
         add_policy_statements_to_user_policy(user_value['Policies'], user_statements, environment)
-    # Add Group Scopes
-    if 'Groups' in user_value:
-        for group in user_value['Groups']:
-            if 'Scopes' in groups[group]:
-                for group_scope in groups[group]['Scopes']:
-                    #if 'Policies' in group_scope:
-                    add_scope_statements_to_user_policy(group_scope, user_statements, environment)
-            if 'Policies' in groups[group]:
-                #if environment in groups[group]['Policies']:
-                add_policy_statements_to_user_policy(groups[group]['Policies'], user_statements, environment)
-            # if 'ManagedPolicies' in groups[group]:
-            #     if environment in groups[group]['ManagedPolicies']:
-            #         for policymanaged in groups[group]['ManagedPolicies']:
-            #             user_statements.append(policymanaged)
-
     if 'Statements' in user_value:
         for statement in user_value['Statements']:
             user_statements.append(statement)
     # Minimize Statements
     user_statements_minimized = consolidate_statements(user_statements)
+    # Merge with the groups' statements, consolidated once for all their members
+    if groups:
+        group_statements = get_group_statements(context, groups, environment)
+        if not user_statements_minimized:
+            return list(group_statements)
+        user_statements_minimized = merge_consolidated_statements([group_statements, user_statements_minimized])
     return user_statements_minimized
 
-def generate_user_template(user, user_value, environment):
-    template_user_child = read_file('templates/' + FILE_TEMPLATE_USERS_CHILD)
+def get_user_template_location(user, environment):
+    return OUTPUT_FOLDER + '/users/' + environment + '/' + FILE_TEMPLATE_USERS_CHILD + '-' + user
+
+# Hash of everything a user's child template is generated from
+def get_user_inputs_hash(context, user, user_value, environment):
+    groups = user_value.get('Groups', [])
+    scope_policies = {
+        scope: BuildContext.environment_policies(context.scope_policies.get(scope, {}), environment) or [] for scope in context.user_scopes[user]
+    }
+    other_policies = [
+        BuildContext.environment_policies(policies, environment) or []
+        for policies in [user_value.get('Policies', {})] + [context.groups[group].get('Policies', {}) for group in groups]
+    ]
+    return hash_inputs({
+        'Code': get_code_version(),
+        'Template': get_template_hash(FILE_TEMPLATE_USERS_CHILD),
+        'Environment': environment,
+        'SsoAccountId': context.sso_account_id,
+        'User': user,
+        'Config': user_value,
+        'Groups': { group: context.groups[group] for group in groups },
+        'ScopePolicies': scope_policies,
+        'PolicyInputs': get_policy_inputs(list(scope_policies.values()) + other_policies)
+    })
+
+def generate_user_template(context, user, user_value, environment):
+    template_user_child = read_template(FILE_TEMPLATE_USERS_CHILD)
     # Generate User Policy
-    user_statements = generate_user_statements(user, user_value, environment)
-    template_user_child = insert_user_into_userstack(template_user_child, user, user_value, user_statements, environment)
+    user_statements = generate_user_statements(context, user, user_value, environment)
+    template_user_child = insert_user_into_userstack(context, template_user_child, user, user_value, user_statements, environment)
 
     # Output User Child file
-    write_file(OUTPUT_FOLDER + '/users/' + environment + '/' + FILE_TEMPLATE_USERS_CHILD + '-' + user, template_user_child)
+    location = get_user_template_location(user, environment)
+    return location, write_file(location, template_user_child)
+
+# Build context of a worker process, set once by init_user_worker
+worker_context = None
+
+def init_user_worker(context):
+    global worker_context
+    worker_context = context
+
+# Consolidate one (groups, environment) combination within a worker
+def generate_group_statements_item(item):
+    groups, environment = item
+    with instrumentation.entity('groups', '+'.join(groups), environment):
+        return generate_group_statements(worker_context, groups, environment)
+
+# Generate one (user, environment) template within a worker
+def generate_user_template_item(item):
+    user, environment = item
+    with instrumentation.entity('user', user, environment):
+        return generate_user_template(worker_context, user, worker_context.users[user], environment)
 
-def generate_user_templates(environment):
+def generate_users_parent_template(context, environment):
     # Open files
-    users = read_file(FILE_CONFIG_USERS)
-    template_users_parent = read_file('templates/' + FILE_TEMPLATE_USERS_PARENT)
-    # Loop through users
-    for user, user_value in users.items():
-        # Insert Users child stack into Users parent stack
+    template_users_parent = read_template(FILE_TEMPLATE_USERS_PARENT)
+    # Insert Users child stacks into Users parent stack, in Config-Users order
+    for user in context.users:
         insert_childstack_into_parentstack(template_users_parent, user, environment['Name'])
-        # Generate user template
-        generate_user_template(user, user_value, environment['Name'])
-        
     # Save file
     write_file(OUTPUT_FOLDER + '/users/' + environment['Name'] + '/' + FILE_TEMPLATE_USERS_PARENT, template_users_parent)
-    return
 
 def main():
+    context = load_build_context()
+    # Load shared data before workers start, so they inherit it rather than each loading it
+    get_policy_library()
+    get_managed_policy_cache()
+    # Only generate templates whose inputs changed since the previous build, each (user, environment) is independent
+    manifest = load_manifest('users')
+    items = []
+    for env in context.workload_accounts:
+        for user, user_value in context.users.items():
+            location = get_user_template_location(user, env['Name'])
+            inputs_hash = get_user_inputs_hash(context, user, user_value, env['Name'])
+            reused = manifest.is_current(location, inputs_hash)
+            if reused:
+                record_output_file(location)
+            else:
+                items.append((user, env['Name']))
+            manifest.record(location, inputs_hash, reused)
+    # Consolidate each combination of groups those users are in once per environment, before users need them
+    group_items = list(dict.fromkeys(
+        (tuple(context.users[user]['Groups']), environment) for user, environment in items if context.users[user].get('Groups')
+    ))
+    group_statements_memo.update(zip(group_items, run_parallel(generate_group_statements_item, group_items, WORKERS, init_user_worker, (context,))))
+    # Generate user templates
+    for location, changed in run_parallel(generate_user_template_item, items, WORKERS, init_user_worker, (context,)):
+        record_output_file(location, changed)
+    manifest.save()
+    print('Users: ' + manifest.summary())
     # Loop through workload environments
-    environments = read_file(FILE_CONFIG_ENVIRONMENTS)
-    for env in environments['WorkloadAccounts']:
-        # Generate users template
-        generate_user_templates(env)
+    for env in context.workload_accounts:
+        # Generate users parent template
+        generate_users_parent_template(context, env)
+    finish_output('users')
+    write_instrumentation_report('users')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
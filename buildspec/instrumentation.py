@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+def entity_key(kind, name, environment):
+    return kind + ':' + name + (':' + environment if environment else '')
+
+# Instrumentation
+# Opt-in timing of named build phases (config load, policy resolution, consolidation, packing, write...)
+# per scope/user/environment, plus counts of AWS API calls and retries made by instrumented clients.
+class Instrumentation():
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.entities = {}
+        self.api_calls = {}
+        self.api_attempts = {}
+
+    def enable(self):
+        self.enabled = True
+
+    # Attribute phases run within this block to an entity (ex: user Joe in Dev)
+    @contextmanager
+    def entity(self, kind, name, environment=None):
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            entity = self.entities.setdefault(entity_key(kind, name, environment), {
+                'Kind': kind,
+                'Name': name,
+                'Environment': environment,
+                'Seconds': 0,
+                'Phases': {}
+            })
+        previous = getattr(self.local, 'entity', None)
+        self.local.entity = entity
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.local.entity = previous
+            with self.lock:
+                entity['Seconds'] += time.perf_counter() - start
+
+    # Time a named phase, attributed to the current entity if there is one
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            entity = getattr(self.local, 'entity', None)
+            with self.lock:
+                phase = self.phases.setdefault(name, { 'Seconds': 0, 'Count': 0 })
+                phase['Seconds'] += seconds
+                phase['Count'] += 1
+                if entity is not None:
+                    entity['Phases'][name] = entity['Phases'].get(name, 0) + seconds
+
+    # Count API calls and HTTP attempts through botocore's client event hooks.
+    # Attempts beyond the first for a call are retries. Registered first so handlers
+    # that answer a call themselves (ex: stubs) can't hide it.
+    def instrument_client(self, client):
+        if self.enabled:
+            client.meta.events.register_first('before-call', self.count_api_call)
+            client.meta.events.register_first('before-send', self.count_api_attempt)
+        return client
+
+    def count_api_call(self, event_name, **kwargs):
+        operation = '.'.join(event_name.split('.')[1:3])
+        with self.lock:
+            self.api_calls[operation] = self.api_calls.get(operation, 0) + 1
+
+    def count_api_attempt(self, event_name, **kwargs):
+        operation = '.'.join(event_name.split('.')[1:3])
+        with self.lock:
+            self.api_attempts[operation] = self.api_attempts.get(operation, 0) + 1
+
+    def report(self):
+        return {
+            'Phases': self.phases,
+            'ApiCalls': self.api_calls,
+            'ApiRetries': {
+                operation: self.api_attempts.get(operation, 0) - calls for operation, calls in self.api_calls.items()
+                if self.api_attempts.get(operation, 0) > calls
+            },
+            'Entities': sorted(self.entities.values(), key=lambda entity: -entity['Seconds'])
+        }
+
+    # Add another process's report into this one
+    def merge(self, report):
+        with self.lock:
+            for name, phase in report['Phases'].items():
+                total = self.phases.setdefault(name, { 'Seconds': 0, 'Count': 0 })
+                total['Seconds'] += phase['Seconds']
+                total['Count'] += phase['Count']
+            for operation, calls in report['ApiCalls'].items():
+                self.api_calls[operation] = self.api_calls.get(operation, 0) + calls
+                self.api_attempts[operation] = self.api_attempts.get(operation, 0) + calls + report['ApiRetries'].get(operation, 0)
+            for entity in report['Entities']:
+                total = self.entities.setdefault(entity_key(entity['Kind'], entity['Name'], entity['Environment']), dict(entity, Seconds=0, Phases={}))
+                total['Seconds'] += entity['Seconds']
+                for name, seconds in entity['Phases'].items():
+                    total['Phases'][name] = total['Phases'].get(name, 0) + seconds
+
+    def write_report(self, location):
+        os.makedirs(os.path.dirname(location) or '.', exist_ok=True)
+        with open(location, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+    # Phase totals, API calls and the slowest entities
+    def summary(self, top=10):
+        report = self.report()
+        lines = ['Phases:']
+        for name, phase in sorted(report['Phases'].items(), key=lambda item: -item[1]['Seconds']):
+            lines.append('  {:<20} {:>10.3f}s {:>8} runs'.format(name, phase['Seconds'], phase['Count']))
+        lines.append('AWS API calls:')
+        for operation, calls in sorted(report['ApiCalls'].items()):
+            lines.append('  {:<40} {:>6} calls {:>6} retries'.format(operation, calls, report['ApiRetries'].get(operation, 0)))
+        lines.append('Slowest ' + str(top) + ':')
+        for entity in report['Entities'][:top]:
+            name = entity['Kind'] + ' ' + entity['Name'] + (' (' + entity['Environment'] + ')' if entity['Environment'] else '')
+            phases = ', '.join('{} {:.3f}s'.format(phase, seconds) for phase, seconds in sorted(entity['Phases'].items(), key=lambda item: -item[1]))
+            lines.append('  {:<40} {:>10.3f}s  {}'.format(name, entity['Seconds'], phases))
+        return '\n'.join(lines)
+
+instrumentation = Instrumentation()
@@ -0,0 +1,88 @@
+import copy
+import fcntl
+import json
+import os
+import time
+
+# Managed Policy Cache
+# Keeps AWS managed policy documents on disk keyed by (PolicyArn, DefaultVersionId)
+# so repeat builds only ask IAM for the default version once the TTL expires,
+# and offline builds can generate templates from the cached snapshot alone.
+class ManagedPolicyCache():
+
+    def __init__(self, location, ttl, offline=False, client=None):
+        self.location = location
+        self.ttl = ttl
+        self.offline = offline
+        self.client = client
+        self.policies = {}
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.location):
+            with open(self.location) as f:
+                self.policies = json.load(f)
+
+    # Write cache atomically so an interrupted build never leaves a partial file.
+    # Parallel builds share the file, so merge in what other processes saved since, under a lock.
+    def save(self):
+        os.makedirs(os.path.dirname(self.location) or '.', exist_ok=True)
+        with open(self.location + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(self.location):
+                with open(self.location) as f:
+                    self.merge(json.load(f))
+            location_tmp = self.location + '.' + str(os.getpid()) + '.tmp'
+            with open(location_tmp, 'w') as f:
+                json.dump(self.policies, f, indent=4, sort_keys=True)
+            os.replace(location_tmp, self.location)
+
+    # Add another copy's versions, keeping the most recently checked default version
+    def merge(self, policies):
+        for policy_arn, other in policies.items():
+            policy = self.policies.get(policy_arn)
+            if policy is None:
+                self.policies[policy_arn] = other
+                continue
+            for version, statements in other['Versions'].items():
+                policy['Versions'].setdefault(version, statements)
+            if other['CheckedAt'] > policy['CheckedAt']:
+                policy['DefaultVersionId'] = other['DefaultVersionId']
+                policy['CheckedAt'] = other['CheckedAt']
+
+    # Get the default version's statements of a managed policy
+    def get(self, policy_arn):
+        policy = self.entry(policy_arn)
+        return copy.deepcopy(policy['Versions'][policy['DefaultVersionId']])
+
+    # Get the default version id of a managed policy
+    def version(self, policy_arn):
+        return self.entry(policy_arn)['DefaultVersionId']
+
+    # Get a managed policy's cache entry, checking IAM for its default version once the TTL expires
+    def entry(self, policy_arn):
+        policy = self.policies.get(policy_arn)
+        if self.offline:
+            if policy is None:
+                raise ValueError("Managed policy '" + policy_arn + "' is not cached. Run online once to populate " + self.location + ".")
+            return policy
+        # Trust cached default version until TTL expires
+        if policy is not None and time.time() - policy['CheckedAt'] < self.ttl:
+            return policy
+        # Check default version, only download document if version not cached
+        policy_version = self.client.get_policy(
+            PolicyArn=policy_arn
+        )['Policy']['DefaultVersionId']
+        if policy is None:
+            policy = { 'Versions': {} }
+            self.policies[policy_arn] = policy
+        if policy_version not in policy['Versions']:
+            policy['Versions'][policy_version] = self.client.get_policy_version(
+                PolicyArn=policy_arn,
+                VersionId=policy_version
+            )['PolicyVersion']['Document']['Statement']
+        policy['DefaultVersionId'] = policy_version
+        policy['CheckedAt'] = time.time()
+        self.save()
+        return policy
+
@@ -0,0 +1,42 @@
+import hashlib
+import json
+import os
+
+# Hash of the inputs an output is generated from. Inputs must be JSON serializable.
+def hash_inputs(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+# Manifest
+# Maps each generated file to the hash of the inputs it was generated from. Files whose inputs
+# hash the same as in the previous build's manifest are reused instead of being generated again.
+class Manifest():
+
+    def __init__(self, location, enabled=True):
+        self.location = location
+        self.enabled = enabled
+        self.previous = {}
+        self.current = {}
+        self.reused = 0
+        if enabled and os.path.isfile(location):
+            with open(location) as f:
+                self.previous = json.load(f)
+
+    # Check if a file was generated from the same inputs and still exists
+    def is_current(self, location, inputs_hash):
+        return self.enabled and self.previous.get(location) == inputs_hash and os.path.isfile(location + '.template')
+
+    def record(self, location, inputs_hash, reused=False):
+        self.current[location] = inputs_hash
+        if reused:
+            self.reused += 1
+
+    def summary(self):
+        return 'reused ' + str(self.reused) + ' of ' + str(len(self.current)) + ' generated files'
+
+    # Write manifest atomically, only files recorded this build are kept
+    def save(self):
+        os.makedirs(os.path.dirname(self.location) or '.', exist_ok=True)
+        location_tmp = self.location + '.' + str(os.getpid()) + '.tmp'
+        with open(location_tmp, 'w') as f:
+            json.dump(self.current, f, indent=4, sort_keys=True)
+        os.replace(location_tmp, self.location)
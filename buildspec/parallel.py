@@ -0,0 +1,40 @@
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import instrumentation
+
+# Parallel
+# Runs independent, CPU bound work items across a pool of processes. Results come back in item
+# order so callers can assemble output deterministically. With one worker, or one item, items
+# run in this process instead. Instrumentation gathered in workers is merged into this process's.
+
+def init_worker(initializer, initargs):
+    # Forked workers start with a copy of the parent's measurements
+    instrumentation.reset()
+    if initializer is not None:
+        initializer(*initargs)
+
+def run_item(function, item):
+    result = function(item)
+    report = None
+    if instrumentation.enabled:
+        report = instrumentation.report()
+        instrumentation.reset()
+    return result, report
+
+# Call function on each item, initializer(*initargs) runs once in each worker first
+def run_parallel(function, items, workers, initializer=None, initargs=()):
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [function(item) for item in items]
+    workers = min(workers, len(items))
+    # A few chunks per worker keeps workers busy without sending every item separately
+    chunksize = max(1, len(items) // (workers * 4))
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(initializer, initargs)) as executor:
+        for result, report in executor.map(functools.partial(run_item, function), items, chunksize=chunksize):
+            if report is not None:
+                instrumentation.merge(report)
+            results.append(result)
+    return results
@@ -1,5 +1,47 @@
 import json
 import pprint
+from compiled_template import CompiledTemplate
+from fragments import intern_fragment
+
+# Fragments every pipeline repeats, shared between them
+ARTIFACT_STORE = intern_fragment({
+    "Type":"S3",
+    "Location":{
+        "Ref": "S3Bucket"
+    },
+    "EncryptionKey": {
+        "Id": {
+            "Fn::GetAtt": [
+                "KmsKey",
+                "Arn"
+            ]
+        },
+        "Type":"KMS"
+    }
+})
+PIPELINE_ROLE_ARN = intern_fragment({
+    "Fn::GetAtt": [
+        "IamRoleCodePipeline",
+        "Arn"
+    ]
+})
+PIPELINE_KMS_KEY_ARN_OVERRIDE = intern_fragment({
+    "Fn::Sub": [
+        "\"PipelineKmsKeyArn\": \"${KmsKeyArn}\",",
+        {
+            "KmsKeyArn": {
+                "Fn::GetAtt": [
+                    "KmsKey",
+                    "Arn"
+                ]
+            }
+        }
+    ]
+})
+MAIN_PIPELINE_OVERRIDE = intern_fragment({
+    "Fn::Sub": "\"MainPipeline\": \"${MainPipeline}\","
+})
+NO_VALUE = intern_fragment({ "Ref": "AWS::NoValue" })
 
 class Builder():
     def __init__(self, parent, context):
@@ -35,22 +77,22 @@ class CodeCommitBuilder(Builder):
             return self.parent
         repo_name = self.source_repo.split(':')[1]
         self.action = {
-            "ActionTypeId":{
+            "ActionTypeId":intern_fragment({
                 "Category":"Source",
                 "Owner":"AWS",
                 "Provider":"CodeCommit",
                 "Version":"1"
-            },
+            }),
             "Configuration":{
                 "RepositoryName": repo_name,
                 "BranchName":"master"
             },
             "Name":"CodeCommit",
-            "OutputArtifacts":[
+            "OutputArtifacts":intern_fragment([
                 {
                     "Name":"SourceOutput"
                 }
-            ],
+            ]),
             "RunOrder": 1,
             "RoleArn": {
                 "Fn::Sub":"arn:aws:iam::${AWS::AccountId}:role/cicd-${MainPipeline}-scopes-" + self.scope + "-CodePipelineRole"
@@ -73,12 +115,12 @@ class GitHubBuilder(Builder):
         repo_name = self.source_repo.split(':')[2]
         repo_token = self.source_repo.split(':')[3]
         self.action = {
-            "ActionTypeId":{
+            "ActionTypeId":intern_fragment({
                 "Category": "Source",
                 "Owner": "ThirdParty",
                 "Provider": "GitHub",
                 "Version": "1"
-            },
+            }),
             "Configuration":{
                 "Branch":"master",
                 "Owner": repo_owner,
@@ -87,11 +129,11 @@ class GitHubBuilder(Builder):
                 "PollForSourceChanges": "True"
             },
             "Name":"GitHub",
-            "OutputArtifacts":[
+            "OutputArtifacts":intern_fragment([
                 {
                     "Name":"SourceOutput"
                 }
-            ],
+            ]),
             "RunOrder": 1,
             "RoleArn": {
                 "Fn::Sub":"arn:aws:iam::${AWS::AccountId}:role/cicd-${MainPipeline}-scopes-" + self.scope + "-CodePipelineRole"
@@ -131,12 +173,12 @@ class CicdCloudFormationBuilder(Builder):
         if not self.cicd_cloudformation:
             return self.parent
         self.action = {
-            "ActionTypeId":{
+            "ActionTypeId":intern_fragment({
                 "Category":"Deploy",
                 "Owner":"AWS",
                 "Provider":"CloudFormation",
                 "Version":"1"
-            },
+            }),
             "Configuration": {
                 "ActionMode":"REPLACE_ON_FAILURE",
                 "Capabilities":"CAPABILITY_IAM,CAPABILITY_AUTO_EXPAND",
@@ -147,7 +189,7 @@ class CicdCloudFormationBuilder(Builder):
                     "Fn::Sub": self.environment['Name'].lower() + "-" + self.scope + "-" + self.subscope
                 },
                 "TemplatePath": "SourceOutput::CloudFormation-CICD.template",
-                "TemplateConfiguration": "SourceOutput::cfvars/" + self.environment['Name'] + ".template" if self.include_cf_vars else { "Ref": "AWS::NoValue" },
+                "TemplateConfiguration": "SourceOutput::cfvars/" + self.environment['Name'] + ".template" if self.include_cf_vars else NO_VALUE,
                 "ParameterOverrides": {
                     "Fn::Join": [
                         "",
@@ -155,25 +197,11 @@ class CicdCloudFormationBuilder(Builder):
                             "{",
                             "\"PipelineS3BucketName\": { \"Fn::GetArtifactAtt\": [\"SourceOutput\", \"BucketName\"]},",
                             "\"PipelineS3ObjectKey\": { \"Fn::GetArtifactAtt\": [\"SourceOutput\", \"ObjectKey\"]},",
-                            {
-                                "Fn::Sub": [
-                                    "\"PipelineKmsKeyArn\": \"${KmsKeyArn}\",",
-                                    {
-                                        "KmsKeyArn": {
-                                            "Fn::GetAtt": [
-                                                "KmsKey",
-                                                "Arn"
-                                            ]
-                                        }
-                                    }
-                                ]
-                            },
+                            PIPELINE_KMS_KEY_ARN_OVERRIDE,
                             {
                                 "Fn::Sub": "\"Environment\": \"" + self.environment['Name'].lower() + "\","
                             },
-                            {
-                                "Fn::Sub": "\"MainPipeline\": \"${MainPipeline}\","
-                            },
+                            MAIN_PIPELINE_OVERRIDE,
                             {
                                 "Fn::Sub": "\"Scope\": \"" + self.scope + "\","
                             },
@@ -186,11 +214,11 @@ class CicdCloudFormationBuilder(Builder):
                 }
             },
             "Name": "DeployCloudFormation",
-            "InputArtifacts": [
+            "InputArtifacts": intern_fragment([
                 {
                     "Name": "SourceOutput"
                 }
-            ],
+            ]),
             "RunOrder": 1,
             "RoleArn": {
                 "Fn::Sub":"arn:aws:iam::" + self.environment['AccountId'] + ":role/" + self.environment['Name'].lower() + "-${MainPipeline}-scopes-" + self.scope + "-CodePipelineRole"
@@ -208,29 +236,29 @@ class CicdCodeBuildBuilder(Builder):
         if not self.cicd_codebuild:
             return self.parent
         self.action = {
-            "ActionTypeId": {
+            "ActionTypeId": intern_fragment({
                 "Category": "Build",
                 "Owner": "AWS",
                 "Provider": "CodeBuild",
                 "Version": "1"
-            },
+            }),
             "Configuration": {
                 "ProjectName": {
                     "Fn::Sub": self.environment['Name'].lower() + "-" + self.scope + "-" + self.subscope + "-CodeBuild"
                 }
             },
             "Name": "RunCodeBuild",
-            "InputArtifacts": [
+            "InputArtifacts": intern_fragment([
                 {
                     "Name": "SourceOutput"
                 }
-            ],
+            ]),
             "RunOrder": 2,
-            "OutputArtifacts":[
+            "OutputArtifacts":intern_fragment([
                 {
                     "Name":"BuildOutput"
                 }
-            ],
+            ]),
             "RoleArn": {
                 "Fn::Sub":"arn:aws:iam::" + self.environment['AccountId'] + ":role/" + self.environment['Name'].lower() + "-${MainPipeline}-scopes-" + self.scope + "-CodePipelineRole"
             }
@@ -270,12 +298,12 @@ class SdlcCloudFormationBuilder(Builder):
             return self.parent
         self.parent.actions.append(
             {
-                "ActionTypeId":{
+                "ActionTypeId":intern_fragment({
                     "Category":"Deploy",
                     "Owner":"AWS",
                     "Provider":"CloudFormation",
                     "Version":"1"
-                },
+                }),
                 "Configuration":{
                     "ActionMode":"REPLACE_ON_FAILURE",
                     "Capabilities":"CAPABILITY_IAM,CAPABILITY_AUTO_EXPAND",
@@ -284,7 +312,7 @@ class SdlcCloudFormationBuilder(Builder):
                     },
                     "StackName":  self.environment['Name'].lower() + "-" + self.scope + "-" + self.subscope if not self.sdlc_stack_name else self.sdlc_stack_name.replace('${Environment}', self.environment['Name'].lower()),
                     "TemplatePath": "BuildOutput::CloudFormation-SDLC.template" if self.cicd_codebuild else "SourceOutput::CloudFormation-SDLC.template",
-                    "TemplateConfiguration": ( "BuildOutput::cfvars/" + self.environment['Name'] + ".template" if self.cicd_codebuild else "SourceOutput::cfvars/" + self.environment['Name'] + ".template" ) if self.include_cf_vars else { "Ref": "AWS::NoValue" },
+                    "TemplateConfiguration": ( "BuildOutput::cfvars/" + self.environment['Name'] + ".template" if self.cicd_codebuild else "SourceOutput::cfvars/" + self.environment['Name'] + ".template" ) if self.include_cf_vars else NO_VALUE,
                     "ParameterOverrides":{
                         "Fn::Join": [
                             "",
@@ -292,25 +320,11 @@ class SdlcCloudFormationBuilder(Builder):
                                 "{",
                                 "\"PipelineS3BucketName\" : { \"Fn::GetArtifactAtt\" : [\"BuildOutput\", \"BucketName\"]}, \"PipelineS3ObjectKey\" : { \"Fn::GetArtifactAtt\" : [\"BuildOutput\", \"ObjectKey\"]}," if self.cicd_codebuild else
                                     "\"PipelineS3BucketName\" : { \"Fn::GetArtifactAtt\" : [\"SourceOutput\", \"BucketName\"]}, \"PipelineS3ObjectKey\" : { \"Fn::GetArtifactAtt\" : [\"SourceOutput\", \"ObjectKey\"]},",
-                                {
-                                    "Fn::Sub": [
-                                        "\"PipelineKmsKeyArn\": \"${KmsKeyArn}\",",
-                                        {
-                                            "KmsKeyArn": {
-                                                "Fn::GetAtt": [
-                                                    "KmsKey",
-                                                    "Arn"
-                                                ]
-                                            }
-                                        }
-                                    ]
-                                },
+                                PIPELINE_KMS_KEY_ARN_OVERRIDE,
                                 {
                                     "Fn::Sub": "\"Environment\": \"" + self.environment['Name'].lower() + "\","
                                 },
-                                {
-                                    "Fn::Sub": "\"MainPipeline\": \"${MainPipeline}\","
-                                },
+                                MAIN_PIPELINE_OVERRIDE,
                                 {
                                     "Fn::Sub": "\"Scope\": \"" + self.scope + "\","
                                 },
@@ -323,12 +337,12 @@ class SdlcCloudFormationBuilder(Builder):
                     }
                 },
                 "Name": "DeployCloudFormation" ,
-                "InputArtifacts": [
+                "InputArtifacts": intern_fragment([
                     {
                         "Name": "SourceOutput"
                     },
-                    { "Name": "BuildOutput" } if self.cicd_codebuild else { "Ref": "AWS::NoValue" }
-                ],
+                    { "Name": "BuildOutput" } if self.cicd_codebuild else NO_VALUE
+                ]),
                 "RunOrder": 1,
                 "RoleArn": {
                     "Fn::Sub":"arn:aws:iam::" + self.environment['AccountId'] + ":role/" + self.environment['Name'].lower() + "-${MainPipeline}-scopes-" + self.scope + "-CodePipelineRole"
@@ -346,12 +360,12 @@ class SdlcCodeBuildBuilder(Builder):
             return self.parent
         self.parent.actions.append(
             {
-                "ActionTypeId": {
+                "ActionTypeId": intern_fragment({
                     "Category": "Build",
                     "Owner": "AWS",
                     "Provider": "CodeBuild",
                     "Version": "1"
-                },
+                }),
                 "Configuration": {
                     "ProjectName": {
                         "Fn::Sub": self.environment['Name'].lower() + "-" + self.scope + "-" + self.subscope + "-CodeBuild"
@@ -359,12 +373,12 @@ class SdlcCodeBuildBuilder(Builder):
                     "PrimarySource": "BuildOutput" if self.cicd_codebuild else "SourceOutput"
                 },
                 "Name": "RunCodeBuild",
-                "InputArtifacts": [
+                "InputArtifacts": intern_fragment([
                     {
                         "Name": "SourceOutput"
                     },
-                    { "Name": "BuildOutput" } if self.cicd_codebuild else { "Ref": "AWS::NoValue" }
-                ],
+                    { "Name": "BuildOutput" } if self.cicd_codebuild else NO_VALUE
+                ]),
                 "RunOrder": 3,
                 "RoleArn": {
                     "Fn::Sub":"arn:aws:iam::" + self.environment['AccountId'] + ":role/" + self.environment['Name'].lower() + "-${MainPipeline}-scopes-" + self.scope + "-CodePipelineRole"
@@ -382,21 +396,21 @@ class SdlcEcsBuilder(Builder):
             return self.parent
         self.parent.actions.append(
             {
-                "ActionTypeId": {
+                "ActionTypeId": intern_fragment({
                     "Category": "Deploy",
                     "Owner": "AWS",
                     "Provider": "ECS",
                     "Version": "1"
-                },
+                }),
                 "Configuration": {
                     "ClusterName": self.sdlc_ecs_cluster_name,
                     "ServiceName": self.environment['Name'].lower() + '-' + self.scope + '-' + self.subscope,
                     "FileName": "imagedefinitions.json"
                 },
                 "Name": "DeployEcs",
-                "InputArtifacts": [
+                "InputArtifacts": intern_fragment([
                     { "Name": "BuildOutput" } if self.cicd_codebuild else { "Name": "SourceOutput" }
-                ],
+                ]),
                 "RunOrder": 2,
                 "RoleArn": {
                     "Fn::Sub":"arn:aws:iam::" + self.environment['AccountId'] + ":role/" + self.environment['Name'].lower() + "-${MainPipeline}-scopes-" + self.scope + "-CodePipelineRole"
@@ -441,7 +455,7 @@ class ManualApproval(Builder):
         if not self.manual_approval_postdev or self.environment['Name'].lower() != 'dev':
             return self.parent
         else:
-            self.action = {
+            self.action = intern_fragment({
                 "Name":"ManualApproval",
                 "ActionTypeId":{
                     "Category":"Approval",
@@ -450,7 +464,7 @@ class ManualApproval(Builder):
                     "Provider":"Manual"
                 },
                 "RunOrder": 9
-            }
+            })
             self.parent.actions.append(self.action)
             return self.parent
 
@@ -483,28 +497,9 @@ class PropertiesBuilder(Builder):
 
     def Build(self):
         self.parent.properties = {
-            "ArtifactStore":{
-                "Type":"S3",
-                "Location":{
-                    "Ref": "S3Bucket"
-                },
-                "EncryptionKey": {
-                    "Id": {
-                        "Fn::GetAtt": [
-                            "KmsKey",
-                            "Arn"
-                        ]
-                    },
-                    "Type":"KMS"
-                }
-            },
+            "ArtifactStore": ARTIFACT_STORE,
             "RestartExecutionOnUpdate":"false",
-            "RoleArn": {
-                "Fn::GetAtt": [
-                    "IamRoleCodePipeline",
-                    "Arn"
-                ]
-            },
+            "RoleArn": PIPELINE_ROLE_ARN,
             "Stages": self.stages
         }
         return self.parent
@@ -560,6 +555,66 @@ class EnvironmentBuilder:
             "Name": self.context['Environment']['Name']
         }
 
+# Stage Compiler
+# An environment's stage depends on the environment and a few of the pipeline's parameters, but not on
+# the pipeline's scope or name. Each distinct (parameters, environment) is compiled into a stage once,
+# with placeholders for the scope and name, and instantiated for every pipeline that shares it.
+# Instances share unchanged parts with each other, so they must not be modified.
+
+SCOPE_PLACEHOLDER = '${Pipes::Scope}'
+SUBSCOPE_PLACEHOLDER = '${Pipes::SubScope}'
+
+# Pipeline parameters a stage depends on, with their defaults
+STAGE_PARAMETERS = {
+    'IncludeCfVars': True,
+    'ManualApprovalPostDev': True,
+    'CicdCodeBuild': False,
+    'CicdCloudFormation': False,
+    'SdlcCodeBuild': False,
+    'SdlcCloudFormation': True,
+    'SdlcStackName': None,
+    'SdlcEcs': False,
+    'SdlcEcsClusterName': None
+}
+
+# Actions of each environment type's stage, in order, and the parameters of which at least one has to be set
+# for the stage to have any. ManualApproval follows in every environment.
+STAGE_ACTIONS = {
+    'CICD': {
+        'Enabled': ['CicdCodeBuild', 'CicdCloudFormation'],
+        'Actions': [CicdCloudFormationBuilder, CicdCodeBuildBuilder]
+    },
+    'SDLC': {
+        'Enabled': ['SdlcCodeBuild', 'SdlcCloudFormation'],
+        'Actions': [SdlcCloudFormationBuilder, SdlcEcsBuilder, SdlcCodeBuildBuilder]
+    }
+}
+
+# Compiled stages keyed by (parameters, environment)
+compiled_stages = {}
+
+def compile_stage(parameters, environment):
+    parameters = dict(parameters, Name=SUBSCOPE_PLACEHOLDER, SourceRepo='')
+    stage = EnvironmentBuilder(SCOPE_PLACEHOLDER, [], parameters, environment)
+    stage_actions = STAGE_ACTIONS.get(environment['Type'])
+    if stage_actions is not None and any(parameters[name] for name in stage_actions['Enabled']):
+        for action_builder in stage_actions['Actions']:
+            action_builder(stage, stage.context).Build()
+    ManualApproval(stage, stage.context).Build()
+    return CompiledTemplate(stage.Build(), [SCOPE_PLACEHOLDER, SUBSCOPE_PLACEHOLDER])
+
+# Build a pipeline's stage for an environment, the same as EnvironmentBuilder with every stage and action
+def build_stage(scope, pipeline, environment):
+    # Builders only read the environment's Name, Type and AccountId
+    signature = tuple(pipeline.get(name, default) for name, default in STAGE_PARAMETERS.items()) + (environment['Name'], environment['Type'], environment['AccountId'])
+    if signature not in compiled_stages:
+        parameters = { name: pipeline.get(name, default) for name, default in STAGE_PARAMETERS.items() }
+        compiled_stages[signature] = compile_stage(parameters, environment)
+    return compiled_stages[signature].instantiate({
+        SCOPE_PLACEHOLDER: scope,
+        SUBSCOPE_PLACEHOLDER: pipeline['Name']
+    })
+
 # parameters = {
 #     "IncludeCfVars": True,
 #     "SourceRepo": "codecommit:Backups-Infra"
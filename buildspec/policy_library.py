@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+from compiled_template import CompiledTemplate
+
+# Statement lists a policy file may contain
+STATEMENT_TYPES = [
+    'PipelineStatements',
+    'ServiceStatements',
+    'DeployStatements',
+    'UserStatements'
+]
+POLICY_WILDCARD_SCOPED = 'scoped/*'
+
+# Policy Library
+# Loads and validates every policy file under policies/ once per process so
+# scopes, users and environments resolve policy references from memory.
+# Statements handed out are shared between callers and must not be modified.
+class PolicyLibrary():
+
+    def __init__(self, location='policies'):
+        self.location = location
+        self.policies = {}
+        self.scoped = []
+        # Policy name -> hash of its file, and the AWS managed policies it references
+        self.hashes = {}
+        self.managed_policy_arns = {}
+        # Hash of every policy file's name and contents, changes whenever the library does
+        self.version = None
+        self.load()
+
+    # Load every policy file, keyed by its path relative to the library (ex: scoped/Sqs)
+    def load(self):
+        version = hashlib.sha256()
+        for root, dirs, files in os.walk(self.location):
+            dirs.sort()
+            for filename in sorted(files):
+                if not filename.endswith('.template'):
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.location)[:-len('.template')].replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    contents = f.read()
+                version.update(name.encode() + b'\0' + contents + b'\0')
+                policy = json.loads(contents)
+                self.validate(name, policy)
+                self.hashes[name] = hashlib.sha256(contents).hexdigest()
+                self.managed_policy_arns[name] = sorted(set(
+                    statement['PolicyArn'] for statement_type in STATEMENT_TYPES for statement in policy.get(statement_type, []) if 'PolicyArn' in statement
+                ))
+                # Split into statement lists, compiled for ${Scope} replacement
+                self.policies[name] = {
+                    statement_type: CompiledTemplate(policy.get(statement_type, [])) for statement_type in STATEMENT_TYPES
+                }
+                if name.startswith('scoped/'):
+                    self.scoped.append(name)
+        self.version = version.hexdigest()
+
+    # Make sure a policy file only contains known statement lists
+    def validate(self, name, policy):
+        if type(policy) is not dict:
+            raise ValueError("Policy '" + name + "' must be a JSON object.")
+        for statement_type, statements in policy.items():
+            if statement_type not in STATEMENT_TYPES:
+                raise ValueError("Policy '" + name + "' contains unknown statement list '" + statement_type + "'.")
+            if type(statements) is not list:
+                raise ValueError("Policy '" + name + "' " + statement_type + " must be a list.")
+            for statement in statements:
+                if type(statement) is not dict or ('PolicyArn' not in statement and 'Effect' not in statement):
+                    raise ValueError("Policy '" + name + "' " + statement_type + " contains an invalid statement.")
+
+    # Get a policy's statement list, replacing ${Scope} if a scope is provided
+    def statements(self, name, statement_type, scope=None):
+        if name not in self.policies:
+            raise ValueError("Policy '" + name + "' does not exist in " + self.location + ".")
+        statements = self.policies[name][statement_type]
+        if scope:
+            return statements.instantiate(scope)
+        return statements.template
+
+    # Names of the policies a list of policy references uses
+    def references(self, policies):
+        names = set()
+        if POLICY_WILDCARD_SCOPED in policies:
+            names.update(self.scoped)
+        for policy in policies:
+            if policy != POLICY_WILDCARD_SCOPED:
+                names.add(policy.split(':')[0])
+        return sorted(names)
+
+    # Resolve a list of policy references (scoped/*, app/X, scoped/X:AltScope) into statements. Scope roles
+    # leave every scoped/ policy to scoped/* when it's listed. Users add each reference as listed, and an
+    # alternative scope carries on to the policies listed after it.
+    def resolve(self, policies, statement_type, expand, scope=None, for_users=False):
+        resolved = []
+        # First, add scoped/* if exists
+        if POLICY_WILDCARD_SCOPED in policies:
+            for name in self.scoped:
+                resolved.extend(self.statements(name, statement_type, scope))
+        # Add rest of policies
+        for policy in policies:
+            if policy == POLICY_WILDCARD_SCOPED:
+                continue
+            # Don't re-add resource-scope policies if already added via wildcard
+            if not for_users and policy.startswith('scoped/') and POLICY_WILDCARD_SCOPED in policies:
+                continue
+            # Parse everything before ':' to get policy name, after to get alternative scope name
+            policyname_split = policy.split(':')
+            policy_scope = scope
+            if len(policyname_split) > 1:
+                policy_scope = policyname_split[1]
+                if for_users:
+                    scope = policy_scope
+            for statement in self.statements(policyname_split[0], statement_type, policy_scope):
+                # AWS Policies
+                if 'PolicyArn' in statement:
+                    resolved.extend(expand(statement['PolicyArn']))
+                # Inline Policies
+                else:
+                    resolved.append(statement)
+        return resolved
@@ -0,0 +1,141 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from utils import *
+
+# Stack Discovery
+# Finds the nested stacks of a parent stack (ex: cicd-main-pipelines) and describes them. Every page of the
+# parent's resources is read, and children are described concurrently. Adaptive retries back off and slow the
+# client down when CloudFormation throttles, rather than failing discovery.
+# What's found is saved to a snapshot in CacheFolder/stacks that later generators and update_stacks.py read
+# instead of discovering again. A snapshot is trusted until StackSnapshotTtl expires or the parent stack is
+# updated after it was taken. Offline builds use the snapshot alone.
+
+DESCRIBE_THREADS = 10
+# Snapshots saved in another format are discovered again
+SNAPSHOT_FORMAT = 2
+
+# Max retry config, shared by every thread
+config = Config(
+    retries = dict(
+        max_attempts = 10,
+        mode = 'adaptive'
+    ),
+    max_pool_connections = DESCRIBE_THREADS
+)
+
+# Child stacks discovered by this process, keyed by parent stack name
+snapshots = {}
+
+def get_snapshot_location(stack_name):
+    return CACHE_FOLDER + '/stacks/' + stack_name + '.json'
+
+def load_snapshot(stack_name):
+    location = get_snapshot_location(stack_name)
+    if os.path.isfile(location):
+        with open(location) as f:
+            snapshot = json.load(f)
+        if snapshot.get('Format') == SNAPSHOT_FORMAT:
+            return snapshot
+    return None
+
+# Write snapshot atomically so an interrupted build never leaves a partial file
+def save_snapshot(stack_name, snapshot):
+    location = get_snapshot_location(stack_name)
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    location_tmp = location + '.' + str(os.getpid()) + '.tmp'
+    with open(location_tmp, 'w') as f:
+        json.dump(snapshot, f, indent=4)
+    os.replace(location_tmp, location)
+
+# Forget a stack's snapshot, after its children were changed directly
+def remove_snapshot(stack_name=MAIN_PIPELINE_STACK):
+    snapshots.pop(stack_name, None)
+    location = get_snapshot_location(stack_name)
+    if os.path.isfile(location):
+        os.remove(location)
+
+# When a stack was last changed, for telling whether a snapshot of its children is stale
+def get_stack_version(stack):
+    # A stack mid update hasn't settled on a version yet
+    if stack['StackStatus'].endswith('_IN_PROGRESS'):
+        return None
+    return str(stack.get('LastUpdatedTime', stack.get('CreationTime')))
+
+# Resource summaries of a stack's nested stacks, across every page
+def list_child_stacks(client, stack_name):
+    paginator = client.get_paginator('list_stack_resources')
+    return [
+        rs for page in paginator.paginate(StackName=stack_name) for rs in page['StackResourceSummaries']
+        if rs['ResourceType'] == 'AWS::CloudFormation::Stack'
+    ]
+
+# Describe a stack's nested stacks, keyed by logical id (ex: a scope) in the parent's order.
+# Outputs and Parameters are indexed by key (ex: S3BucketName -> value).
+def describe_child_stacks(client, stack_name):
+    resource_summaries = list_child_stacks(client, stack_name)
+    with ThreadPoolExecutor(max_workers=DESCRIBE_THREADS) as executor:
+        stacks = list(executor.map(
+            lambda rs: client.describe_stacks(StackName=rs['PhysicalResourceId'])['Stacks'][0], resource_summaries
+        ))
+    return {
+        rs['LogicalResourceId']: {
+            'StackId': stack['StackId'],
+            'Outputs': { output['OutputKey']: output['OutputValue'] for output in stack.get('Outputs', []) },
+            'Parameters': { parameter['ParameterKey']: parameter['ParameterValue'] for parameter in stack.get('Parameters', []) }
+        } for rs, stack in zip(resource_summaries, stacks)
+    }
+
+# Get a stack's nested stacks from its snapshot if still current, discovering and saving them otherwise
+def discover_child_stacks(stack_name=MAIN_PIPELINE_STACK, refresh=REFRESH_STACK_SNAPSHOT):
+    if stack_name in snapshots and not refresh:
+        return snapshots[stack_name]
+    snapshot = load_snapshot(stack_name)
+    if OFFLINE:
+        if snapshot is None:
+            raise ValueError("Child stacks of '" + stack_name + "' have no snapshot. Run online once to populate " + get_snapshot_location(stack_name) + ".")
+        snapshots[stack_name] = snapshot['Stacks']
+        return snapshot['Stacks']
+    client = create_client('cloudformation', config=config)
+    stack_version = get_stack_version(client.describe_stacks(StackName=stack_name)['Stacks'][0])
+    if (not refresh and snapshot is not None and stack_version is not None and snapshot['StackVersion'] == stack_version
+        and time.time() - snapshot['Timestamp'] < STACK_SNAPSHOT_TTL):
+        print('Using snapshot of ' + stack_name + ' child stacks taken ' + str(int(time.time() - snapshot['Timestamp'])) + ' seconds ago')
+    else:
+        snapshot = {
+            'Format': SNAPSHOT_FORMAT,
+            'StackName': stack_name,
+            'StackVersion': stack_version,
+            'Timestamp': time.time(),
+            'Stacks': describe_child_stacks(client, stack_name)
+        }
+        save_snapshot(stack_name, snapshot)
+    snapshots[stack_name] = snapshot['Stacks']
+    return snapshot['Stacks']
+
+# Outputs of a stack's nested stacks, keyed by logical id
+def get_child_stack_outputs(stack_name=MAIN_PIPELINE_STACK):
+    return { name: stack['Outputs'] for name, stack in discover_child_stacks(stack_name).items() }
+
+# Parameters of a stack's nested stacks, keyed by logical id
+def get_child_stack_parameters(stack_name=MAIN_PIPELINE_STACK):
+    return { name: stack['Parameters'] for name, stack in discover_child_stacks(stack_name).items() }
+
+# Make sure every name (ex: each scope) has a child stack with the outputs generation needs, listing everything missing at once
+def validate_child_stack_outputs(names, child_stack_outputs, output_keys, stack_name=MAIN_PIPELINE_STACK):
+    missing = []
+    for name in names:
+        if name not in child_stack_outputs:
+            missing.append(name + ' (no child stack)')
+            continue
+        missing_keys = [key for key in output_keys if key not in child_stack_outputs[name]]
+        if missing_keys:
+            missing.append(name + ' (' + ', '.join(missing_keys) + ')')
+    if missing:
+        raise ValueError("Child stacks of '" + stack_name + "' are missing outputs: " + '; '.join(missing) + ". Deploy " + stack_name + " first, or set RefreshStackSnapshot to true if it was just deployed.")
+
+# Check if a snapshot of a stack's nested stacks exists
+def has_snapshot(stack_name=MAIN_PIPELINE_STACK):
+    return os.path.isfile(get_snapshot_location(stack_name))
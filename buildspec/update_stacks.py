@@ -2,81 +2,267 @@ import boto3
 import sys
 import time
 import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError
 from utils import *
 from botocore.config import Config
+from stack_discovery import discover_child_stacks, remove_snapshot
 
-# Max retry config
+# Update Stacks
+# Sets AllEnvironmentsCreated on every child stack of cicd-main-pipelines through change sets. Children already
+# deployed with it are skipped, and change sets that turn out to change nothing are deleted. Change sets are
+# created and executed by up to ChangeSetThreads threads, making at most ChangeSetRate CloudFormation calls a
+# second between them, and each executed change set is handed to a single monitor loop that waits on all of them
+# together. A failed update stops any rollout that hasn't executed yet, and a summary of every stack is printed
+# either way.
+
+# Threads creating and executing change sets, and CloudFormation calls a second across them and the monitor loop
+CHANGE_SET_THREADS = int(os.environ.get('ChangeSetThreads', '10'))
+CHANGE_SET_RATE = float(os.environ.get('ChangeSetRate', '10'))
+# Seconds each stack's change set gets to be created, and then executed
+CHANGE_SET_CREATE_TIMEOUT = int(os.environ.get('ChangeSetCreateTimeout', '90'))
+CHANGE_SET_EXECUTE_TIMEOUT = int(os.environ.get('ChangeSetExecuteTimeout', '150'))
+# Seconds the whole rollout gets, kept under the UpdateStacks project's TimeoutInMinutes (5) in Main.template
+# so stacks still waiting are reported before CodeBuild stops the build
+UPDATE_STACKS_TIMEOUT = int(os.environ.get('UpdateStacksTimeout', '240'))
+ROLLOUT_DEADLINE = time.time() + UPDATE_STACKS_TIMEOUT
+# Polling starts at POLL_DELAY seconds and doubles up to POLL_MAX_DELAY, jittered so stacks don't poll in step
+POLL_DELAY = 2
+POLL_MAX_DELAY = 15
+# Parameters every child stack is updated to
+TARGET_PARAMETERS = { 'AllEnvironmentsCreated': 'True' }
+# Reasons CloudFormation gives for a change set with nothing to do
+NO_CHANGES_REASONS = ["didn't contain changes", 'No updates are to be performed']
+# Change set execution statuses still waited on
+EXECUTING_STATUSES = ['UNAVAILABLE', 'AVAILABLE', 'EXECUTE_IN_PROGRESS']
+# Results that fail the build, and stop the rollout of stacks not yet executed
+FAILED_STATUSES = ['EXECUTE_FAILED', 'TIMED_OUT', 'ERROR']
+
+# Max retry config, shared by every thread
 config = Config(
     retries = dict(
-        max_attempts = 10
-    )
+        max_attempts = 10,
+        mode = 'adaptive'
+    ),
+    max_pool_connections = CHANGE_SET_THREADS + 1
 )
 
-client = boto3.client('cloudformation', config=config)
+client = create_client('cloudformation', config=config)
 
-# List main infra stack resources
-resource_summaries = client.list_stack_resources(
-    StackName=MAIN_PIPELINE_STACK
-)['StackResourceSummaries']
+# Spaces calls out evenly across threads
+class RateLimiter():
 
-# Update Stacks
-change_sets = []
-for rs in resource_summaries:
-    if rs['ResourceType'] == 'AWS::CloudFormation::Stack':
-        stack_parameters = client.describe_stacks(
-            StackName = rs['PhysicalResourceId']
-        )['Stacks'][0]['Parameters']
-        stack_parameters[:] = [d for d in stack_parameters if d.get('ParameterKey') != 'AllEnvironmentsCreated']
-        stack_parameters.append(
-                {
-                    'ParameterKey': 'AllEnvironmentsCreated',
-                    'ParameterValue': 'True',
-                    'UsePreviousValue': False
-                }
-            )
-        # Create Change Set
-        change_set_id = client.create_change_set(
-            StackName = rs['PhysicalResourceId'],
-            UsePreviousTemplate=True,
-            Capabilities=[
-                'CAPABILITY_IAM',
-                'CAPABILITY_NAMED_IAM',
-                'CAPABILITY_AUTO_EXPAND',
-            ],
-            Parameters=stack_parameters,
-            ChangeSetName=ENVIRONMENT + '-' + rs['LogicalResourceId'],
-            ChangeSetType='UPDATE'
-        )['Id']
-        change_set_description = {}
-        # Wait for change set to finish creating
-        while change_set_description == {} or change_set_description['Status'] == 'CREATE_PENDING' or change_set_description['Status'] == 'CREATE_IN_PROGRESS':
-            change_set_description = client.describe_change_set(
-                ChangeSetName=ENVIRONMENT + '-' + rs['LogicalResourceId'],
-                StackName=rs['PhysicalResourceId']
-            )
-        # If created, execute change set
-        if change_set_description['Status'] != 'FAILED':
-            change_set_status = client.execute_change_set(
-                ChangeSetName=ENVIRONMENT + '-' + rs['LogicalResourceId'],
-                StackName=rs['PhysicalResourceId']
-            )
-            # Add to wait to finish list
-            change_sets.append(
-                {
-                    'ChangeSetId': change_set_id,
-                    'ChangeSetName': ENVIRONMENT + '-' + rs['LogicalResourceId'],
-                    'StackName': rs['PhysicalResourceId']
-                }
-            )
-
-# Wait for change sets to finish executing
-for cs in change_sets:
-    execution_status = ''
-    while execution_status == '' or execution_status == 'UNAVAILABLE' or execution_status == 'AVAILABLE' or execution_status == 'EXECUTE_IN_PROGRESS':
-        execution_status = client.describe_change_set(
-            ChangeSetName = cs['ChangeSetId']
-        )['ExecutionStatus']
-        time.sleep(5)
-    if execution_status == 'EXECUTE_FAILED':
-        print("Stack Update Unsuccessful.")
-        sys.exit(1)
\ No newline at end of file
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+rate_limiter = RateLimiter(CHANGE_SET_RATE)
+# Set once a stack fails
+cancelled = threading.Event()
+snapshot_lock = threading.Lock()
+
+# Call a CloudFormation client method within the rate limit
+def call(method, **kwargs):
+    rate_limiter.wait()
+    return getattr(client, method)(**kwargs)
+
+# Call describe until done(result), backing off between calls. Returns the last result, or None past the deadline
+# (or the rollout's) or once the rollout is cancelled.
+def poll(describe, done, deadline):
+    deadline = min(deadline, ROLLOUT_DEADLINE)
+    delay = POLL_DELAY
+    while True:
+        if cancelled.wait(min(random.uniform(delay / 2, delay), max(0, deadline - time.time()))):
+            return None
+        result = describe()
+        if done(result):
+            return result
+        if time.time() >= deadline:
+            return None
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+# A stack's result for the summary. A failed result stops the rollout of stacks not yet executed.
+def stack_result(start, status, reason=''):
+    if status in FAILED_STATUSES:
+        cancelled.set()
+    return { 'Status': status, 'Reason': reason, 'Seconds': time.time() - start }
+
+# Reason a wait for a change set to be created or executed ran out
+def timed_out(stage, timeout):
+    if time.time() >= ROLLOUT_DEADLINE:
+        return 'Change set not ' + stage + ' before UpdateStacksTimeout (' + str(UPDATE_STACKS_TIMEOUT) + ' seconds) ran out.'
+    return 'Change set not ' + stage + ' within ' + str(timeout) + ' seconds.'
+
+# Create and execute a child stack's change set. Returns the stack's result for the summary or, once the change
+# set is executed, an EXECUTE_IN_PROGRESS result for the monitor loop to wait on.
+def roll_out_stack(logical_id, stack):
+    start = time.time()
+    change_set_name = ENVIRONMENT + '-' + logical_id
+    if time.time() >= ROLLOUT_DEADLINE:
+        return stack_result(start, 'TIMED_OUT', 'Not started before UpdateStacksTimeout (' + str(UPDATE_STACKS_TIMEOUT) + ' seconds) ran out.')
+    if cancelled.is_set():
+        return stack_result(start, 'CANCELLED', 'Not started, another stack failed.')
+    # Keep every other parameter as deployed
+    stack_parameters = [
+        {
+            'ParameterKey': key,
+            'UsePreviousValue': True
+        } for key in stack['Parameters'] if key not in TARGET_PARAMETERS
+    ]
+    stack_parameters.extend(
+        {
+            'ParameterKey': key,
+            'ParameterValue': value,
+            'UsePreviousValue': False
+        } for key, value in TARGET_PARAMETERS.items()
+    )
+    try:
+        with instrumentation.entity('stack', logical_id, ENVIRONMENT):
+            # Create Change Set
+            with instrumentation.phase('create'):
+                change_set_id = call(
+                    'create_change_set',
+                    StackName = stack['StackId'],
+                    UsePreviousTemplate=True,
+                    Capabilities=[
+                        'CAPABILITY_IAM',
+                        'CAPABILITY_NAMED_IAM',
+                        'CAPABILITY_AUTO_EXPAND',
+                    ],
+                    Parameters=stack_parameters,
+                    ChangeSetName=change_set_name,
+                    ChangeSetType='UPDATE'
+                )['Id']
+                # Wait for change set to finish creating
+                change_set_description = poll(
+                    lambda: call('describe_change_set', ChangeSetName=change_set_id),
+                    lambda description: description['Status'] not in ['CREATE_PENDING', 'CREATE_IN_PROGRESS'],
+                    time.time() + CHANGE_SET_CREATE_TIMEOUT
+                )
+            if change_set_description is None:
+                # Out of time itself, rather than stopped for another stack
+                if cancelled.is_set() and time.time() < ROLLOUT_DEADLINE:
+                    return stack_result(start, 'CANCELLED', 'Not executed, another stack failed.')
+                return stack_result(start, 'TIMED_OUT', timed_out('created', CHANGE_SET_CREATE_TIMEOUT))
+            if change_set_description['Status'] == 'FAILED':
+                reason = change_set_description.get('StatusReason', '')
+                # Don't leave change sets that would do nothing piling up on the stack
+                if any(no_changes_reason in reason for no_changes_reason in NO_CHANGES_REASONS):
+                    call('delete_change_set', ChangeSetName=change_set_id)
+                    return stack_result(start, 'NO_CHANGES')
+                return stack_result(start, 'FAILED', reason)
+            # Once a stack fails, leave the rest as they are
+            if cancelled.is_set():
+                return stack_result(start, 'CANCELLED', 'Not executed, another stack failed.')
+            # Execute change set
+            with instrumentation.phase('execute'):
+                call('execute_change_set', ChangeSetName=change_set_id)
+                # Children are updated directly, so their snapshot no longer matches them
+                with snapshot_lock:
+                    remove_snapshot()
+            return {
+                'Status': 'EXECUTE_IN_PROGRESS',
+                'ChangeSetId': change_set_id,
+                'Start': start,
+                'Deadline': min(time.time() + CHANGE_SET_EXECUTE_TIMEOUT, ROLLOUT_DEADLINE)
+            }
+    # Ex: the stack is already being updated
+    except ClientError as e:
+        return stack_result(start, 'ERROR', str(e))
+
+# Describe an executing change set. Returns the stack's result for the summary, or None while it's still executing.
+def check_execution(logical_id, execution):
+    start = execution['Start']
+    # Stopped for another stack, rather than out of time itself
+    if cancelled.is_set() and time.time() < ROLLOUT_DEADLINE:
+        return stack_result(start, 'CANCELLED', 'Executed, stopped waiting after another stack failed.')
+    try:
+        with instrumentation.entity('stack', logical_id, ENVIRONMENT):
+            with instrumentation.phase('execute'):
+                execution_status = call('describe_change_set', ChangeSetName=execution['ChangeSetId'])['ExecutionStatus']
+    except ClientError as e:
+        return stack_result(start, 'ERROR', str(e))
+    if execution_status not in EXECUTING_STATUSES:
+        return stack_result(start, execution_status)
+    if time.time() >= execution['Deadline']:
+        return stack_result(start, 'TIMED_OUT', timed_out('executed', CHANGE_SET_EXECUTE_TIMEOUT))
+    return None
+
+# Collect every rollout's result. Change sets are handed over as they're executed, and each round describes every
+# one still executing, backing off between rounds. Rollouts finishing (or failing) don't wait for the next round.
+def monitor_rollouts(futures):
+    results = {}
+    executing = {}
+    pending = set(futures)
+    delay = POLL_DELAY
+    next_round = None
+    while pending or executing:
+        timeout = None if next_round is None else max(0, next_round - time.time())
+        if pending:
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        else:
+            done = []
+            cancelled.wait(timeout)
+        for future in done:
+            result = future.result()
+            if result['Status'] == 'EXECUTE_IN_PROGRESS':
+                executing[futures[future]] = result
+            else:
+                results[futures[future]] = result
+        if not executing:
+            next_round = None
+            continue
+        if next_round is None:
+            delay = POLL_DELAY
+            next_round = min([time.time() + random.uniform(delay / 2, delay)] + [execution['Deadline'] for execution in executing.values()])
+        # Fail fast once a stack fails, otherwise wait for the round
+        if not cancelled.is_set() and time.time() < next_round:
+            continue
+        for logical_id, execution in list(executing.items()):
+            result = check_execution(logical_id, execution)
+            if result is not None:
+                results[logical_id] = result
+                del executing[logical_id]
+        delay = min(delay * 2, POLL_MAX_DELAY)
+        next_round = min([time.time() + random.uniform(delay / 2, delay)] + [execution['Deadline'] for execution in executing.values()])
+    return results
+
+# Describe main infra child stacks
+child_stacks = discover_child_stacks()
+
+# Stacks already deployed with the target parameters have nothing to change
+results = {
+    logical_id: { 'Status': 'UP_TO_DATE', 'Reason': '', 'Seconds': 0 }
+    for logical_id, stack in child_stacks.items()
+    if all(stack['Parameters'].get(key) == value for key, value in TARGET_PARAMETERS.items())
+}
+
+# Roll out every other child
+with ThreadPoolExecutor(max_workers=CHANGE_SET_THREADS) as executor:
+    futures = { executor.submit(roll_out_stack, logical_id, stack): logical_id for logical_id, stack in child_stacks.items() if logical_id not in results }
+    try:
+        results.update(monitor_rollouts(futures))
+    except BaseException:
+        cancelled.set()
+        raise
+
+# Summary, in the parent's order
+print('Stack update results:')
+for logical_id in child_stacks:
+    result = results[logical_id]
+    print('   - ' + logical_id + ': ' + result['Status'] + ' (' + str(round(result['Seconds'], 1)) + 's)' + (' ' + result['Reason'] if result['Reason'] else ''))
+write_instrumentation_report('update-stacks')
+if cancelled.is_set():
+    print("Stack Update Unsuccessful.")
+    sys.exit(1)
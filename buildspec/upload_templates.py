@@ -0,0 +1,103 @@
+import json
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from utils import *
+
+# Upload Templates
+# Uploads generated templates to s3://<S3Bucket>/builds/<kind>/<buildnum>/. Files that haven't changed since
+# the last upload are copied within S3 from that build's prefix, so only changed files leave the build box.
+# Changed files are listed by the generators in CacheFolder/changes/<kind>.txt.
+# The last upload is recorded in CacheFolder/uploads.json, so CacheFolder and output/ have to be kept between builds
+# (ex: by the CodeBuild project cache). Without them every template is generated again and uploaded.
+# With ContentAddressedTemplates, templates go to s3://<S3Bucket>/builds/<kind>/objects/<sha256>.template instead,
+# where unchanged files are already stored, so only changed files are uploaded and nothing is copied.
+
+S3_BUCKET = os.environ.get('S3Bucket')
+UPLOADS_LOCATION = CACHE_FOLDER + '/uploads.json'
+UPLOAD_THREADS = 16
+
+def load_uploads():
+    if os.path.isfile(UPLOADS_LOCATION):
+        with open(UPLOADS_LOCATION) as f:
+            return json.load(f)
+    return {}
+
+def save_uploads(uploads):
+    os.makedirs(os.path.dirname(UPLOADS_LOCATION), exist_ok=True)
+    with open(UPLOADS_LOCATION, 'w') as f:
+        json.dump(uploads, f, indent=4, sort_keys=True)
+
+# Build number of a kind's last upload, if it used the same layout as this one
+def get_previous_build_num(uploads, kind):
+    previous = uploads.get(kind)
+    # Uploads from before layouts were recorded are by build number
+    if type(previous) is str:
+        previous = { 'BuildNum': previous, 'ContentAddressed': False }
+    if previous is None or previous['ContentAddressed'] != CONTENT_ADDRESSED_TEMPLATES:
+        return None
+    return previous['BuildNum']
+
+def upload_templates(s3_client, kind, previous_build_num):
+    folder = OUTPUT_FOLDER + '/' + kind
+    files = sorted(
+        os.path.relpath(os.path.join(root, filename), folder).replace(os.sep, '/')
+        for root, dirs, filenames in os.walk(folder) for filename in filenames
+    )
+    changes_location = CACHE_FOLDER + '/changes/' + kind + '.txt'
+    changes = None
+    if os.path.isfile(changes_location):
+        with open(changes_location) as f:
+            changes = set(f.read().split())
+    # Without a previous upload or a list of changes, everything has to be uploaded
+    if previous_build_num is None or changes is None:
+        changes = set(files)
+
+    def upload(filename):
+        s3_client.upload_file(os.path.join(folder, filename), S3_BUCKET, 'builds/' + get_template_key(kind, os.path.join(folder, filename)[:-len('.template')]))
+
+    def copy(filename):
+        try:
+            s3_client.copy_object(
+                Bucket=S3_BUCKET,
+                Key='builds/' + kind + '/' + BUILD_NUM + '/' + filename,
+                CopySource={
+                    'Bucket': S3_BUCKET,
+                    'Key': 'builds/' + kind + '/' + previous_build_num + '/' + filename
+                }
+            )
+        # Missing from the previous build, upload it instead
+        except ClientError:
+            upload(filename)
+
+    # Content addressed files that haven't changed are already uploaded
+    if CONTENT_ADDRESSED_TEMPLATES:
+        files = [filename for filename in files if filename in changes]
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        # Raise the first failure, if any
+        list(executor.map(lambda filename: upload(filename) if filename in changes else copy(filename), files))
+    print(kind.capitalize() + ': uploaded ' + str(len([f for f in files if f in changes])) + ', copied ' + str(len([f for f in files if f not in changes])))
+    # Changes are uploaded, start the list over
+    if os.path.isfile(changes_location):
+        os.remove(changes_location)
+
+def main():
+    parser = ArgumentParser(description='Upload generated templates, sending only files changed since the last upload.')
+    parser.add_argument('kinds', nargs='+', help='Folders under output/ to upload (ex: scopes users keys).')
+    args = parser.parse_args()
+    # post_build runs even when the build phase failed, don't upload a partial build
+    if os.environ.get('CODEBUILD_BUILD_SUCCEEDING') == '0':
+        print('Build failed, skipping upload.')
+        return
+    s3_client = create_client('s3')
+    uploads = load_uploads()
+    for kind in args.kinds:
+        upload_templates(s3_client, kind, get_previous_build_num(uploads, kind))
+        uploads[kind] = { 'BuildNum': BUILD_NUM, 'ContentAddressed': CONTENT_ADDRESSED_TEMPLATES }
+        save_uploads(uploads)
+    write_instrumentation_report('upload')
+
+if __name__ == "__main__":
+    main()
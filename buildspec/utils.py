@@ -1,9 +1,16 @@
+import glob
+import hashlib
 import json
+import marshal
 import boto3
 import os
-import string
-
-iam_client = boto3.client('iam')
+import consolidation
+from build_context import BuildContext
+from consolidation import num_characters, statement_size
+from instrumentation import instrumentation
+from managed_policy_cache import ManagedPolicyCache
+from manifest import Manifest, hash_inputs
+from policy_library import PolicyLibrary
 
 # Variables
 FILE_CONFIG_SCOPES = 'Config-Scopes'
@@ -23,20 +30,72 @@ FILE_TEMPLATE_KEYS_CHILD = 'Keys-Child'
 MAINSCOPESTACK = 'cicd-main-scopes'
 MAIN_PIPELINE_STACK = 'cicd-main-pipelines'
 OUTPUT_FOLDER = 'output'
+# Max size of a managed policy's statements, leaves headroom under IAM's 6144 character limit
+MAX_MANAGED_POLICY_SIZE = 5900
+MAX_MANAGED_POLICIES_PER_ROLE = 10
+POLICY_FOLDER = 'policies'
+CACHE_FOLDER = os.environ.get('CacheFolder', '.cache')
 BUILD_NUM = os.environ['buildnum']
 ENVIRONMENT = os.environ['Environment']
 #BUILD_NUM = '1'
 #ENVIRONMENT = 'cicd'
+# Seconds to trust a cached managed policy version before checking IAM again
+MANAGED_POLICY_CACHE_TTL = int(os.environ.get('ManagedPolicyCacheTtl', '86400'))
+# Generate only from cached data, without calling AWS
+OFFLINE = os.environ.get('Offline', 'false').lower() == 'true'
+# Seconds to trust the snapshot of cicd-main-pipelines' child stacks, and whether to discover them again regardless
+STACK_SNAPSHOT_TTL = int(os.environ.get('StackSnapshotTtl', '3600'))
+REFRESH_STACK_SNAPSHOT = os.environ.get('RefreshStackSnapshot', 'false').lower() == 'true'
+# Reuse outputs whose inputs haven't changed since the previous build, set to false to regenerate everything
+INCREMENTAL = os.environ.get('Incremental', 'true').lower() == 'true'
+# Processes used for CPU bound generation, 1 to generate serially
+WORKERS = int(os.environ.get('Workers', os.cpu_count() or 1))
+# Point parent stacks at child templates stored under the hash of their contents instead of the build number,
+# so CloudFormation leaves nested stacks whose templates didn't change alone
+CONTENT_ADDRESSED_TEMPLATES = os.environ.get('ContentAddressedTemplates', 'false').lower() == 'true'
+# Time build phases and count AWS API calls, writing a report per generator
+INSTRUMENT = os.environ.get('Instrument', 'false').lower() == 'true'
+INSTRUMENT_FOLDER = os.environ.get('InstrumentFolder', 'instrumentation')
+INSTRUMENT_TOP = int(os.environ.get('InstrumentTop', '10'))
+
+if INSTRUMENT:
+    instrumentation.enable()
+
+# Create a boto3 client, instrumented if enabled
+def create_client(service, **kwargs):
+    return instrumentation.instrument_client(boto3.client(service, **kwargs))
+
+iam_client = create_client('iam')
+
+# Loaded once per process on first use
+policy_library = None
+managed_policy_cache = None
+# Resolved statements keyed by (scope, environment, statement type, policy library version)
+scope_statements_memo = {}
+code_version = None
+template_hashes = {}
+# Sections of templates/ skeletons generators fill in, copied for every caller. Other sections are shared and must not be modified.
+TEMPLATE_FILLED_SECTIONS = ['Resources', 'Outputs']
+# Skeletons parsed once per process, name -> (skeleton, marshalled copy of its filled in sections)
+template_skeletons = {}
+# Files generated this run, location -> whether their contents changed
+output_files = {}
+
+# Get the managed policy cache, loading it from disk on first use
+def get_managed_policy_cache():
+    global managed_policy_cache
+    if managed_policy_cache is None:
+        managed_policy_cache = ManagedPolicyCache(
+            CACHE_FOLDER + '/managed-policies.json',
+            MANAGED_POLICY_CACHE_TTL,
+            OFFLINE,
+            iam_client
+        )
+    return managed_policy_cache
 
 # Get IAM AWS Managed policy statements
 def get_policy_statements(policy_arn):
-    policy_version = iam_client.get_policy(
-        PolicyArn=policy_arn
-    )['Policy']['DefaultVersionId']
-    policy_statement = iam_client.get_policy_version(
-        PolicyArn=policy_arn,
-        VersionId=policy_version
-    )['PolicyVersion']['Document']['Statement']
+    policy_statement = get_managed_policy_cache().get(policy_arn)
     for statement in policy_statement:
         if type(statement['Resource']) is not list:
             statement['Resource'] = [statement['Resource']]
@@ -51,332 +110,194 @@ def get_policy_statements(policy_arn):
 
 # Open file
 def read_file(location):
-    with open(location + '.template') as f:
+    with instrumentation.phase('load'), open(location + '.template') as f:
         contents = json.load(f)
     f.close()
     return contents
 
-# Save file
+# Open a template skeleton from templates/ (ex: Scopes-Child) to fill in. The file is only read and parsed
+# once, each caller gets its own copy of the sections generators fill in. marshal copies them faster than
+# copy.deepcopy or parsing the file again.
+def read_template(name):
+    if name not in template_skeletons:
+        skeleton = read_file('templates/' + name)
+        template_skeletons[name] = (skeleton, marshal.dumps({
+            section: skeleton[section] for section in TEMPLATE_FILLED_SECTIONS if section in skeleton
+        }))
+    skeleton, filled_sections = template_skeletons[name]
+    with instrumentation.phase('load'):
+        template = dict(skeleton)
+        template.update(marshal.loads(filled_sections))
+    return template
+
+# Save file, leaving it untouched if its contents are the same. Returns whether it changed.
 def write_file(location, contents):
-    # Create directory if doesn't exist
-    os.makedirs(os.path.dirname(location + '.template'), exist_ok=True)
-    # Save Pipeline Template file
-    with open(location + '.template', 'w') as f:
-        json.dump(contents, f, indent=4)
-    f.close()
+    with instrumentation.phase('write'):
+        contents = json.dumps(contents, indent=4)
+        changed = True
+        if os.path.isfile(location + '.template'):
+            with open(location + '.template') as f:
+                changed = f.read() != contents
+        if changed:
+            # Create directory if doesn't exist
+            os.makedirs(os.path.dirname(location + '.template'), exist_ok=True)
+            # Save Pipeline Template file
+            with open(location + '.template', 'w') as f:
+                f.write(contents)
+        record_output_file(location, changed)
+        return changed
 
-# Calculate number of characters in an object
-def num_characters(o):
-    string_o = json.dumps(o)
-    string_o = string_o.translate({ord(c): None for c in string.whitespace})
-    return len(string_o)
+# Record a file as generated this run, for files written by worker processes or reused from the previous build
+def record_output_file(location, changed=False):
+    output_files[location] = changed
 
-# Add policy statements from config files
-def add_policy_statements(template, scope, scope_value, environment):
-    # Only add policies if exists
-    if 'Policies' in scope_value:
-        # If environment doesn't exist, set to default
-        if environment not in scope_value['Policies']:
-            environment = 'Default'
-        if environment in scope_value['Policies']:
-            # Add scoped/* if exists
-            if 'scoped/*' in scope_value['Policies'][environment]:
-                for filename in os.listdir('policies/scoped'):
-                    with open('policies/scoped/' + filename) as f:
-                        d = json.load(f)
-                    if 'PipelineStatements' in d:
-                        for s in d['PipelineStatements']:
-                            template['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'].append(s)
-                    if 'ServiceStatements' in d:
-                        for s in d['ServiceStatements']:
-                            template['Resources']['IamPolicyService']['Properties']['PolicyDocument']['Statement'].append(s)
-                    if 'DeployStatements' in d:
-                        for s in d['DeployStatements']:
-                            template['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement'].append(s)
-            # Add rest of policies
-            for ps in scope_value['Policies'][environment]:
-                # Add scoped policy if isn't scoped/*
-                if ps != 'scoped/*':
-                    # Don't re-add resource-scope policies if already added via wildcard
-                    if not ps.startswith('scoped/') or 'scoped/*' not in scope_value['Policies'][environment]:
-                        # Parse everything before ':' to get file name
-                        policyname_split = ps.split(':')
-                        with open('policies/' + str(policyname_split[0]) + '.template') as json_file:
-                            data = json.load(json_file)
-                        # If contains alternative scope name, replace scope within file
-                        if len(policyname_split) > 1:
-                            data = json.loads(json.dumps(data).replace('${Scope}', policyname_split[1]))
-                        if 'PipelineStatements' in data:
-                            for statement in data['PipelineStatements']:
-                                # AWS Policies
-                                if 'PolicyArn' in statement:
-                                    template['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'].extend(get_policy_statements(statement['PolicyArn']))
-                                # Inline Policies
-                                else:
-                                    template['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'].append(statement)
-                        if 'ServiceStatements' in data:
-                            for statement in data['ServiceStatements']:
-                                # AWS Policies
-                                if 'PolicyArn' in statement:
-                                    template['Resources']['IamPolicyService']['Properties']['PolicyDocument']['Statement'].extend(get_policy_statements(statement['PolicyArn']))
-                                # Inline Policies
-                                else:
-                                    template['Resources']['IamPolicyService']['Properties']['PolicyDocument']['Statement'].append(statement)
-                        if 'DeployStatements' in data:
-                            for statement in data['DeployStatements']:
-                                if 'PolicyArn' in statement:
-                                    template['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement'].extend(get_policy_statements(statement['PolicyArn']))
-                                else:
-                                    template['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement'].append(statement)
-    return template
+# Remove a kind of output's files (ex: scopes) that weren't generated this run, and add the ones that changed
+# to the kind's list of changes waiting to be uploaded. The list is cleared by upload_templates.py once uploaded.
+def finish_output(kind):
+    folder = OUTPUT_FOLDER + '/' + kind
+    removed = []
+    for root, dirs, files in os.walk(folder):
+        for filename in files:
+            location = os.path.join(root, filename)[:-len('.template')]
+            if filename.endswith('.template') and location not in output_files:
+                os.remove(location + '.template')
+                removed.append(location)
+    changes_location = CACHE_FOLDER + '/changes/' + kind + '.txt'
+    changes = set()
+    if os.path.isfile(changes_location):
+        with open(changes_location) as f:
+            changes = set(f.read().split())
+    changes.update(
+        os.path.relpath(location + '.template', folder) for location, changed in output_files.items()
+        if changed and location.startswith(folder + '/')
+    )
+    changes = sorted(change for change in changes if os.path.isfile(os.path.join(folder, change)))
+    os.makedirs(os.path.dirname(changes_location), exist_ok=True)
+    with open(changes_location, 'w') as f:
+        f.write(''.join(change + '\n' for change in changes))
+    print(kind.capitalize() + ': ' + str(len(changes)) + ' changed files to upload, ' + str(len(removed)) + ' removed')
+
+# Hash of a generated file's contents
+def get_file_hash(location):
+    with open(location + '.template', 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Key a generated file (ex: output/scopes/Dev/Scopes-Child-Foo) is uploaded to under builds/, by build number or by contents
+def get_template_key(kind, location):
+    if CONTENT_ADDRESSED_TEMPLATES:
+        return kind + '/objects/' + get_file_hash(location) + '.template'
+    return kind + '/' + BUILD_NUM + '/' + os.path.relpath(location, OUTPUT_FOLDER + '/' + kind).replace(os.sep, '/') + '.template'
+
+# TemplateURL of a child template, which has to be generated first when content addressed
+def get_template_url(kind, location):
+    return "https://s3.amazonaws.com/${S3BucketName}/builds/" + get_template_key(kind, location)
+
+# Config-* file of each config in a build context
+CONFIG_FILES = {
+    'environments': FILE_CONFIG_ENVIRONMENTS,
+    'scopes': FILE_CONFIG_SCOPES,
+    'users': FILE_CONFIG_USERS,
+    'groups': FILE_CONFIG_GROUPS,
+    'keys': FILE_CONFIG_KEYS
+}
+
+def read_config(name):
+    return read_file(CONFIG_FILES[name])
+
+# Build context over the Config-* files, each read once when first used
+def load_build_context():
+    return BuildContext(read_config)
 
-# Check if a policy's actions contains a specific service
-def action_contains_service(service, action):
-    if len(action) > 0:
-        # List of String
-        if type(action) is list:
-            for item in action:
-                if item.split(':')[0] == service:
-                    return True
-        # String
-        else:
-            if action.split(':')[0] == service:
-                return True
-        # Tests passed.
-    return False
+# Load the manifest of a kind of output (ex: scopes) from the previous build
+def load_manifest(kind):
+    return Manifest(CACHE_FOLDER + '/manifests/' + kind + '.json', INCREMENTAL)
 
-# Check if a policy's resources contains a specific service
-def resource_contains_service(service, resource):
-    if len(resource) > 0:
-        # List
-        if type(resource) is list:
-            for item in resource:
-                # List of Dict
-                if type(item) is dict:
-                    for key, value in item.items():
-                        if key != "Fn::Sub":
-                            return False
-                        if value.split(':')[2] == service:
-                            return True
-                # List of String
-                else:
-                    if item.split(':')[2] == service:
-                        return True
-        # Dict
-        elif type(resource) is dict:
-            for key, value in resource.items():
-                if value.split(':')[2] == service:
-                    return True
-        # String
-        else:
-            if resource.split(':')[2] == service:
-                return True
-    # Tests passed.
-    return False
+# Hash of the generators' code, so changing a generator regenerates everything
+def get_code_version():
+    global code_version
+    if code_version is None:
+        version = hashlib.sha256()
+        for location in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+            with open(location, 'rb') as f:
+                version.update(f.read())
+        code_version = version.hexdigest()
+    return code_version
 
-# Checks to see if 2 given statements are mergable
-def is_statements_mergable(statement1, statement2):
-    # Effect
-    if statement1['Effect'] != statement2['Effect']:
-        return False
-    # Action
-    # Make sure both are either wildcard or non wildcard
-    if (statement1['Action'] == "*" or statement1['Action'] == ["*"]) != (statement2['Action'] == "*" or statement2['Action'] == ["*"]):
-        return False
-    # Can merge actions if wildcard
-    if statement1['Action'] != '*' and statement1['Action'] != ['*']:
-        for action in statement1['Action']:
-            service = action.split(':')[0]
-            # If resources are wildcard, we don't need to check if action contains service
-            if (statement1['Resource'] != "*" and statement1['Resource'] != ["*"]) or (statement2['Resource'] != "*" and statement2['Resource'] != ["*"]):
-                if action_contains_service(service, statement2['Action']):
-                    return False
-            # # Not really necessary, but just in case
-            # elif resource_contains_service(service, statement2['Resource']):
-            #     return False
-    # Resource -- Kinda taken care of above. But need to implement in the future just in case
-    # Make sure both are either wildcard or non wildcard
-    if (statement1['Resource'] == "*" or statement1['Resource'] == ["*"]) != (statement2['Resource'] == "*" or statement2['Resource'] == ["*"]):
-        return False
-    if statement1['Resource'] != '*' and statement1['Resource'] != ['*']:
-        #print(statement1)
-        for resource in statement1['Resource']:
-            # Get AWS Service
-            service = ""
-            # String
-            if type(resource) is str:
-                service = resource.split(':')[2]
-            # Dict
-            else:
-                for key, value in resource.items():
-                    if key != "Fn::Sub":
-                        return False
-                    if type(value) is list:
-                        return False
-                    service = value.split(':')[2]
-            if resource_contains_service(service, statement2['Resource']):
-                return False
+# Hash of a template skeleton in templates/
+def get_template_hash(name):
+    if name not in template_hashes:
+        with open('templates/' + name + '.template', 'rb') as f:
+            template_hashes[name] = hashlib.sha256(f.read()).hexdigest()
+    return template_hashes[name]
 
-    # Condition
-    # Make sure conditions either both exist or both don't
-    if ('Condition' in statement1) != ('Condition' in statement2):
-        return False
-    if 'Condition' in statement1:
-        if statement1['Condition'] != statement2['Condition']:
-            return False
-    # Don't combine if statement size is greater than 5900
-    if num_characters(statement1) + num_characters(statement2) > 5900:
-        return False
-    # Passed
-    return True
+# Inputs of resolving lists of policy references: the policy files they use and the versions of the AWS managed policies those reference
+def get_policy_inputs(policy_lists):
+    library = get_policy_library()
+    names = sorted(set(name for policies in policy_lists for name in library.references(policies)))
+    return {
+        'Policies': { name: library.hashes.get(name) for name in names },
+        'ManagedPolicies': {
+            policy_arn: get_managed_policy_cache().version(policy_arn) for name in names for policy_arn in library.managed_policy_arns.get(name, [])
+        }
+    }
 
-# Consolidates a list of statements
+# Consolidate statements, timed as its own phase
 def consolidate_statements(statements):
-    # Create arrays for each iteration of consolidating
-    statements_merged_sids = []
-    statements_merged_intelligent = []
-    statements_split_size = []
+    with instrumentation.phase('consolidation'):
+        return consolidation.consolidate_statements(statements)
 
-    # Group Similar SID's
-    statement_map = {}
-    for s in statements:
-        # Skip all merging if NotAction or NotResource
-        if 'NotAction' in s or 'NotResource' in s:
-            statements_split_size.append(s)
-        # Skip merging by sids if doesn't exist and add directly to statements_merged_sids list
-        elif 'Sid' not in s:
-            statements_merged_sids.append(s)
-        # Sid exists, add to statement map if doesn't exist
-        else:
-            if s["Sid"] not in statement_map:
-                statement_map[s["Sid"]] = []
-            statement_map[s["Sid"]].append(s)
-    # Loop through SID statements and combine resources
-    for sid, statement_list in statement_map.items():
-        # Loop through the rest of the statements
-        base_sid_statement = {}
-        for statement in statement_list:
-            # If base_sid_statement not set yet, use statement for base_sid_statement
-            if not base_sid_statement:
-                base_sid_statement = statement
-                # Make Resource a list if isn't already
-                if type(base_sid_statement['Resource']) is dict:
-                    base_sid_statement['Resource'] = [
-                        base_sid_statement['Resource']
-                    ]
-            # If does exist, merge statement into base_sid_statement
-            else:
-                # Add resources to base_sid_statement
-                # If resource wildcard, don't merge resources
-                if statement['Resource'] != "*" and statement['Resource'] != ["*"]:
-                    # Multiple Resources
-                    if type(statement['Resource']) is list:
-                        for resource in statement['Resource']:
-                            # Check if key value pair exist in resources
-                            for key, value in resource.items():
-                                if not any(d.get(key, None) == value for d in base_sid_statement['Resource']):
-                                    base_sid_statement['Resource'].append(resource)
-                    # Single resource
-                    elif type(statement['Resource']) is dict:
-                        for key, value in statement['Resource'].items():
-                            if not any(d.get(key, None) == value for d in base_sid_statement['Resource']):
-                                base_sid_statement['Resource'].append(statement['Resource'])
+# Consolidate already consolidated blocks of statements into one list, timed with consolidation
+def merge_consolidated_statements(blocks):
+    with instrumentation.phase('consolidation'):
+        return consolidation.merge_consolidated_statements(blocks)
 
-                # Add Conditions to base_sid_statement
-                if 'Condition' in statement:
-                    for condition, condition_value in statement['Condition'].items():
-                        for statement_name, statement_value in condition_value.items():
-                            for item in statement_value:
-                                if type(item) is str:
-                                    if item not in base_sid_statement['Condition'][condition][statement_name]:
-                                        base_sid_statement['Condition'][condition][statement_name].append(item)
-                                else:
-                                    for key, value in item.items():
-                                        # Check if key value pair exists in condition_value
-                                        if not any(d.get(key, None) == value for d in base_sid_statement['Condition'][condition][statement_name]):
-                                            # If not, insert it
-                                            base_sid_statement['Condition'][condition][statement_name].append({key: value})
-        if base_sid_statement:
-            statements_merged_sids.append(base_sid_statement)
+# Write the instrumentation report for a generator run and print a summary, then start over for the next run
+def write_instrumentation_report(generator):
+    if instrumentation.enabled:
+        instrumentation.write_report(INSTRUMENT_FOLDER + '/' + generator + '.json')
+        print(instrumentation.summary(INSTRUMENT_TOP))
+        instrumentation.reset()
 
-    # Perform final merge of SIDs
-    for statement in statements_merged_sids:
-        # Create Sid prefix string used for statement
-        sid_effect = statement['Effect']
-        sid_action = "ActWild" if statement['Action'] == "*" or statement['Action'] == ["*"] else "ActScope"
-        sid_resource = "ResWild" if statement['Resource'] == "*" or statement['Resource'] == ["*"] else "ResScope"
-        sid_condition = "Cond" if 'Condition' in statement else "NoCond"
-        sid = sid_effect + sid_action + sid_resource + sid_condition
-        # Search for existing sids with matching pattern
-        results = list(filter(lambda statement: statement['Sid'].startswith(sid), statements_merged_intelligent))
-        merged = False
-        num_results = len(results)
-        for result in results:
-            if is_statements_mergable(result, statement):
-                # Add Resources
-                if sid_resource != "ResWild":
-                    for resource in statement['Resource']:
-                        result['Resource'].append(resource)
-                # Add Actions
-                if sid_action != "ActWild":
-                    for action in statement['Action']:
-                        if action not in result['Action']:
-                            result['Action'].append(action)
-                # Add Conditions
-                if 'Condition' in statement:
-                    for condition, condition_content in statement['Condition'].items():
-                        for condition_key, condition_value in condition_content.items():
-                            for item in condition_value:
-                                if type(item) is dict:
-                                    for key, value in item.items():
-                                        if not any(d.get(key, None) == value for d in result['Condition'][condition][condition_key]):
-                                            result['Condition'][condition][condition_key].append({key: value})
-                                # String
-                                else:
-                                    if item not in result['Condition'][condition][condition_key]:
-                                        result['Condition'][condition][condition_key].append(item)
-                merged = True
-                break
-        if not merged:
-            if type(statement['Action']) is not list:
-                statement['Action'] = [statement['Action']]
-            if type(statement['Resource']) is not list:
-                statement['Resource'] = [statement['Resource']]
-            item = {
-                "Sid": sid + str(num_results),
-                "Effect": statement['Effect'],
-                "Action": statement['Action'],
-                "Resource": statement['Resource']
-            }
-            if 'Condition' in statement:
-                item['Condition'] = statement['Condition']
-            # Add new statement to final list
-            statements_merged_intelligent.append(item)
+# Get the policy library, loading policies/ on first use
+def get_policy_library():
+    global policy_library
+    if policy_library is None:
+        policy_library = PolicyLibrary(POLICY_FOLDER)
+    return policy_library
 
-    # Split statement actions if too big
-    # Can easily happen on resource wildcards (ex: readonly policies)
-    for rs in statements_merged_intelligent:
-        # Get size of statement action
-        rs_size = num_characters(rs['Action'])
-        # Calculate num of splits
-        num_of_split_statements = (rs_size // 5900) + 1
-        # No split needed
-        if num_of_split_statements == 1:
-            statements_split_size.append(rs)
-        # Split needed
-        else:
-            # Calculate desired length of action post split
-            statement_size = (len(rs['Action']) // num_of_split_statements) + 1
-            # Peform split
-            for i in range(0, len(rs['Action']), statement_size):
-                item = {
-                    "Effect": rs['Effect'],
-                    "Resource": rs['Resource'],
-                    "Sid": rs['Sid'] + 'Split' + str(i),
-                    "Action": rs['Action'][i:i + statement_size]
-                }
-                if 'Condition' in rs:
-                    item['Condition'] = rs['Condition']
-                statements_split_size.append(item)
+# Resolve policy references into statements, expanding AWS managed policies
+def resolve_policy_statements(policies, statement_type, scope=None, for_users=False):
+    with instrumentation.phase('policies'):
+        return get_policy_library().resolve(policies, statement_type, get_policy_statements, scope, for_users)
 
-    return statements_split_size
\ No newline at end of file
+# Get a scope's resolved statements for an environment, resolved once and shared by every user
+# and group with the scope. A tuple, neither it nor its statements may be modified.
+def get_scope_statements(context, scope, environment, statement_type):
+    key = (scope, environment, statement_type, get_policy_library().version)
+    statements = scope_statements_memo.get(key)
+    if statements is None:
+        statements = ()
+        if scope in context.scope_policies:
+            policies = BuildContext.environment_policies(context.scope_policies[scope], environment)
+            if policies is not None:
+                statements = tuple(resolve_policy_statements(policies, statement_type, scope, True))
+        scope_statements_memo[key] = statements
+    return statements
+
+# Add policy statements from config files
+def add_policy_statements(template, scope, scope_value, environment):
+    # Only add policies if exists
+    if 'Policies' in scope_value:
+        # If environment doesn't exist, fall back to default
+        policies = BuildContext.environment_policies(scope_value['Policies'], environment)
+        if policies is not None:
+            template['Resources']['IamPolicyPipeline']['Properties']['PolicyDocument']['Statement'].extend(
+                resolve_policy_statements(policies, 'PipelineStatements')
+            )
+            template['Resources']['IamPolicyService']['Properties']['PolicyDocument']['Statement'].extend(
+                resolve_policy_statements(policies, 'ServiceStatements')
+            )
+            template['Resources']['IamPolicyDeploy']['Properties']['PolicyDocument']['Statement'].extend(
+                resolve_policy_statements(policies, 'DeployStatements')
+            )
+    return template
@@ -0,0 +1,393 @@
+#!/usr/bin/python
+# Verify Consolidation
+# Checks that consolidation grants exactly what the original consolidate_statements granted. Statement lists
+# built from the policies/ files (scope substituted like the generators do) and randomly generated ones are
+# consolidated by both, and each result is expanded to its set of (Effect, Action, Resource, Condition) grants.
+# Layouts (Sids, statement order, how actions and resources are grouped) may differ, the grants may not.
+#
+#   python buildspec/verify_consolidation.py
+#   python buildspec/verify_consolidation.py --cases 5000 --seed 7
+import copy
+import glob
+import json
+import os
+import random
+import string
+import sys
+from argparse import ArgumentParser
+
+from consolidation import consolidate_statements, merge_consolidated_statements, num_characters, statement_size
+
+BUILDSPEC_FOLDER = os.path.dirname(os.path.abspath(__file__))
+POLICY_FOLDER = os.path.join(os.path.dirname(BUILDSPEC_FOLDER), 'policies')
+STATEMENT_TYPES = ['DeployStatements', 'ServiceStatements', 'UserStatements', 'PipelineStatements']
+SCOPES = ['Orders', 'Billing', 'Search']
+SERVICES = ['s3', 'dynamodb', 'sqs', 'sns', 'kms', 'lambda', 'logs', 'iam']
+
+# Original consolidation, kept as the reference the current one is checked against
+
+def original_num_characters(o):
+    string_o = json.dumps(o)
+    string_o = string_o.translate({ord(c): None for c in string.whitespace})
+    return len(string_o)
+
+def original_action_contains_service(service, action):
+    if len(action) > 0:
+        if type(action) is list:
+            for item in action:
+                if item.split(':')[0] == service:
+                    return True
+        else:
+            if action.split(':')[0] == service:
+                return True
+    return False
+
+def original_resource_contains_service(service, resource):
+    if len(resource) > 0:
+        if type(resource) is list:
+            for item in resource:
+                if type(item) is dict:
+                    for key, value in item.items():
+                        if key != "Fn::Sub":
+                            return False
+                        if value.split(':')[2] == service:
+                            return True
+                else:
+                    if item.split(':')[2] == service:
+                        return True
+        elif type(resource) is dict:
+            for key, value in resource.items():
+                if value.split(':')[2] == service:
+                    return True
+        else:
+            if resource.split(':')[2] == service:
+                return True
+    return False
+
+def original_is_statements_mergable(statement1, statement2):
+    if statement1['Effect'] != statement2['Effect']:
+        return False
+    if (statement1['Action'] == "*" or statement1['Action'] == ["*"]) != (statement2['Action'] == "*" or statement2['Action'] == ["*"]):
+        return False
+    if statement1['Action'] != '*' and statement1['Action'] != ['*']:
+        for action in statement1['Action']:
+            service = action.split(':')[0]
+            if (statement1['Resource'] != "*" and statement1['Resource'] != ["*"]) or (statement2['Resource'] != "*" and statement2['Resource'] != ["*"]):
+                if original_action_contains_service(service, statement2['Action']):
+                    return False
+    if (statement1['Resource'] == "*" or statement1['Resource'] == ["*"]) != (statement2['Resource'] == "*" or statement2['Resource'] == ["*"]):
+        return False
+    if statement1['Resource'] != '*' and statement1['Resource'] != ['*']:
+        for resource in statement1['Resource']:
+            service = ""
+            if type(resource) is str:
+                service = resource.split(':')[2]
+            else:
+                for key, value in resource.items():
+                    if key != "Fn::Sub":
+                        return False
+                    if type(value) is list:
+                        return False
+                    service = value.split(':')[2]
+            if original_resource_contains_service(service, statement2['Resource']):
+                return False
+    if ('Condition' in statement1) != ('Condition' in statement2):
+        return False
+    if 'Condition' in statement1:
+        if statement1['Condition'] != statement2['Condition']:
+            return False
+    if original_num_characters(statement1) + original_num_characters(statement2) > 5900:
+        return False
+    return True
+
+def original_merge_conditions(target, statement):
+    for condition, condition_content in statement['Condition'].items():
+        for condition_key, condition_value in condition_content.items():
+            for item in condition_value:
+                if type(item) is dict:
+                    for key, value in item.items():
+                        if not any(d.get(key, None) == value for d in target['Condition'][condition][condition_key]):
+                            target['Condition'][condition][condition_key].append({key: value})
+                else:
+                    if item not in target['Condition'][condition][condition_key]:
+                        target['Condition'][condition][condition_key].append(item)
+
+# Modifies its input like the original did, pass it a copy
+def original_consolidate_statements(statements):
+    statements_merged_sids = []
+    statements_merged_intelligent = []
+    statements_split_size = []
+    statement_map = {}
+    for s in statements:
+        if 'NotAction' in s or 'NotResource' in s:
+            statements_split_size.append(s)
+        elif 'Sid' not in s:
+            statements_merged_sids.append(s)
+        else:
+            statement_map.setdefault(s["Sid"], []).append(s)
+    for sid, statement_list in statement_map.items():
+        base_sid_statement = {}
+        for statement in statement_list:
+            if not base_sid_statement:
+                base_sid_statement = statement
+                if type(base_sid_statement['Resource']) is dict:
+                    base_sid_statement['Resource'] = [
+                        base_sid_statement['Resource']
+                    ]
+            else:
+                if statement['Resource'] != "*" and statement['Resource'] != ["*"]:
+                    if type(statement['Resource']) is list:
+                        for resource in statement['Resource']:
+                            for key, value in resource.items():
+                                if not any(d.get(key, None) == value for d in base_sid_statement['Resource']):
+                                    base_sid_statement['Resource'].append(resource)
+                    elif type(statement['Resource']) is dict:
+                        for key, value in statement['Resource'].items():
+                            if not any(d.get(key, None) == value for d in base_sid_statement['Resource']):
+                                base_sid_statement['Resource'].append(statement['Resource'])
+                if 'Condition' in statement:
+                    original_merge_conditions(base_sid_statement, statement)
+        if base_sid_statement:
+            statements_merged_sids.append(base_sid_statement)
+    for statement in statements_merged_sids:
+        sid_effect = statement['Effect']
+        sid_action = "ActWild" if statement['Action'] == "*" or statement['Action'] == ["*"] else "ActScope"
+        sid_resource = "ResWild" if statement['Resource'] == "*" or statement['Resource'] == ["*"] else "ResScope"
+        sid_condition = "Cond" if 'Condition' in statement else "NoCond"
+        sid = sid_effect + sid_action + sid_resource + sid_condition
+        results = list(filter(lambda statement: statement['Sid'].startswith(sid), statements_merged_intelligent))
+        merged = False
+        num_results = len(results)
+        for result in results:
+            if original_is_statements_mergable(result, statement):
+                if sid_resource != "ResWild":
+                    for resource in statement['Resource']:
+                        result['Resource'].append(resource)
+                if sid_action != "ActWild":
+                    for action in statement['Action']:
+                        if action not in result['Action']:
+                            result['Action'].append(action)
+                if 'Condition' in statement:
+                    original_merge_conditions(result, statement)
+                merged = True
+                break
+        if not merged:
+            if type(statement['Action']) is not list:
+                statement['Action'] = [statement['Action']]
+            if type(statement['Resource']) is not list:
+                statement['Resource'] = [statement['Resource']]
+            item = {
+                "Sid": sid + str(num_results),
+                "Effect": statement['Effect'],
+                "Action": statement['Action'],
+                "Resource": statement['Resource']
+            }
+            if 'Condition' in statement:
+                item['Condition'] = statement['Condition']
+            statements_merged_intelligent.append(item)
+    for rs in statements_merged_intelligent:
+        num_of_split_statements = (original_num_characters(rs['Action']) // 5900) + 1
+        if num_of_split_statements == 1:
+            statements_split_size.append(rs)
+        else:
+            statement_size = (len(rs['Action']) // num_of_split_statements) + 1
+            for i in range(0, len(rs['Action']), statement_size):
+                item = {
+                    "Effect": rs['Effect'],
+                    "Resource": rs['Resource'],
+                    "Sid": rs['Sid'] + 'Split' + str(i),
+                    "Action": rs['Action'][i:i + statement_size]
+                }
+                if 'Condition' in rs:
+                    item['Condition'] = rs['Condition']
+                statements_split_size.append(item)
+    return statements_split_size
+
+# Expanding statements into grants
+
+def canonical(value):
+    return json.dumps(value, sort_keys=True)
+
+def as_list(value):
+    return value if type(value) is list else [value]
+
+# Conditions are ANDed across operators and keys, and ORed across a key's values, so a condition is
+# the set of single value combinations that satisfy it
+def expand_condition(condition):
+    if condition is None:
+        return [None]
+    combinations = [frozenset()]
+    for operator, content in sorted(condition.items()):
+        for key, values in sorted(content.items()):
+            combinations = [
+                combination | { (operator, key, canonical(value)) } for combination in combinations for value in as_list(values)
+            ]
+    return combinations
+
+# Services whose actions apply to another service's resources (ex: sts:AssumeRole on an IAM role)
+ACTION_RESOURCE_SERVICES = { 'sts': 'iam' }
+
+# Whether an action can apply to a resource. Actions never apply to another service's resources, so
+# consolidation may group an s3 action with a dynamodb table without granting anything.
+def is_effective(action, resource):
+    if action == '*' or resource == '*':
+        return True
+    # Values imported from the keys stacks are KMS key ARNs
+    if type(resource) is dict and 'Fn::ImportValue' in resource and canonical(resource['Fn::ImportValue']).endswith('KmsKeyArn"}'):
+        resource = 'arn:aws:kms'
+    arn = resource.get('Fn::Sub') if type(resource) is dict else resource
+    if type(arn) is not str or len(arn.split(':')) < 3:
+        return True
+    service = arn.split(':')[2]
+    if service in ['', '*'] or '$' in service:
+        return True
+    action_service = action.split(':')[0]
+    return service == ACTION_RESOURCE_SERVICES.get(action_service, action_service)
+
+# Every effective (Effect, Action, Resource, Condition) a list of statements grants. NotAction and NotResource
+# statements aren't merged, so they're compared whole.
+def expand_statements(statements):
+    grants = set()
+    for s in statements:
+        if 'NotAction' in s or 'NotResource' in s:
+            grants.add(('Not', canonical({ key: value for key, value in s.items() if key != 'Sid' })))
+            continue
+        conditions = expand_condition(s.get('Condition'))
+        for action in as_list(s['Action']):
+            for resource in as_list(s['Resource']):
+                if is_effective(action, resource):
+                    for condition in conditions:
+                        grants.add((s['Effect'], action, canonical(resource), condition))
+    return grants
+
+# Inputs
+
+def load_policies():
+    policies = {}
+    for location in sorted(glob.glob(os.path.join(POLICY_FOLDER, '**', '*.template'), recursive=True)):
+        with open(location) as f:
+            policies[os.path.relpath(location, POLICY_FOLDER)[:-len('.template')].replace(os.sep, '/')] = f.read()
+    return policies
+
+# A policy file's statements of a type with ${Scope} replaced, as the generators read them.
+# References to AWS managed policies (PolicyArn) are resolved from IAM by the generators, so they're left out.
+def policy_statements(policies, name, statement_type, scope):
+    data = json.loads(policies[name].replace('${Scope}', scope))
+    return [s for s in data.get(statement_type, []) if 'PolicyArn' not in s]
+
+def random_resource(rng):
+    service = rng.choice(SERVICES)
+    return { "Fn::Sub": "arn:aws:" + service + ":${AWS::Region}:${AWS::AccountId}:" + rng.choice(SCOPES).lower() + "-" + str(rng.randint(0, 3)) }
+
+# Sids, with the shape every statement sharing one has, since statements sharing a Sid come from the same policy
+def random_sid_shapes(rng):
+    shapes = {}
+    for i in range(rng.randint(1, 6)):
+        shape = {
+            'Effect': rng.choice(['Allow', 'Allow', 'Deny']),
+            'Action': rng.choice(['*', ['*'], [rng.choice(SERVICES) + ':Action' + str(n) for n in range(rng.randint(1, 4))]]),
+            'ResourceWildcard': rng.random() < 0.2
+        }
+        if rng.random() < 0.3:
+            shape['Condition'] = 'aws:ResourceTag/Scope' + str(rng.randint(0, 1))
+        shapes['Sid' + str(i)] = shape
+    return shapes
+
+def random_statement(rng, sid_shapes):
+    if rng.random() < 0.05:
+        return { "Effect": "Deny", "NotAction": [rng.choice(SERVICES) + ':*'], "Resource": "*" }
+    sid = rng.choice(list(sid_shapes) + [None, None])
+    if sid is None:
+        shape = random_sid_shapes(rng)['Sid0']
+        # Large action lists are split by size
+        if rng.random() < 0.05:
+            shape['Action'] = [rng.choice(SERVICES) + ':LongActionName' + str(n) for n in range(rng.randint(200, 600))]
+    else:
+        shape = sid_shapes[sid]
+    statement = { "Effect": shape['Effect'], "Action": copy.deepcopy(shape['Action']) }
+    if sid is not None:
+        statement['Sid'] = sid
+    if shape['ResourceWildcard']:
+        statement['Resource'] = rng.choice(['*', ['*']])
+    elif rng.random() < 0.3:
+        statement['Resource'] = random_resource(rng)
+    else:
+        statement['Resource'] = [random_resource(rng) for n in range(rng.randint(1, 4))]
+    if 'Condition' in shape:
+        statement['Condition'] = { "StringEquals": { shape['Condition']: rng.sample(SCOPES, rng.randint(1, 2)) } }
+    return statement
+
+# Statement lists like the generators build: policy files for a few scopes, and randomly generated statements.
+# Policy file lists come with the blocks a user generator would consolidate apart: a group's scopes and the user's
+# own, which never include the group's.
+def generate_cases(rng, policies, cases):
+    names = sorted(policies)
+    for statement_type in STATEMENT_TYPES:
+        yield [s for name in names for s in policy_statements(policies, name, statement_type, SCOPES[0])], None
+    for case in range(cases):
+        if case % 2 == 0:
+            statement_type = rng.choice(STATEMENT_TYPES)
+            group_scopes = rng.sample(SCOPES, rng.randint(1, len(SCOPES) - 1))
+            user_scopes = [scope for scope in SCOPES if scope not in group_scopes]
+            blocks = [
+                [
+                    s for scope in block_scopes for name in rng.sample(names, rng.randint(1, min(8, len(names))))
+                    for s in policy_statements(policies, name, statement_type, scope)
+                ] for block_scopes in [group_scopes, user_scopes]
+            ]
+            yield blocks[0] + blocks[1], blocks
+        else:
+            sid_shapes = random_sid_shapes(rng)
+            yield [random_statement(rng, sid_shapes) for n in range(rng.randint(1, 40))], None
+
+# Checks
+
+# Problems with consolidating a list of statements (and the blocks it's made of, if any) compared to the original
+def check_consolidation(statements, blocks):
+    expected = expand_statements(original_consolidate_statements(copy.deepcopy(statements)))
+    original = copy.deepcopy(statements)
+    consolidated = consolidate_statements(statements)
+    actual = expand_statements(consolidated)
+    problems = []
+    if statements != original:
+        problems.append('input statements were modified')
+    if actual != expected:
+        problems.append('grants differ: ' + str(len(expected - actual)) + ' missing, ' + str(len(actual - expected)) + ' extra')
+    # Statements keep count of their own size, which has to match their encoded size
+    if any(statement_size(s) != num_characters(s) for s in consolidated):
+        problems.append('statement sizes are off')
+    # Blocks consolidated apart and then merged are never Sid merged together. The original merged statements
+    # sharing a Sid across scopes, which could pair one scope's resources with another's conditions, so merged
+    # blocks may grant less than the original but never more.
+    narrowed = False
+    if blocks is not None:
+        merged = expand_statements(merge_consolidated_statements([consolidate_statements(block) for block in blocks]))
+        if not merged <= expected:
+            problems.append('merged blocks grant ' + str(len(merged - expected)) + ' more')
+        narrowed = merged != expected
+    return problems, narrowed
+
+def main():
+    parser = ArgumentParser(description='Check that consolidation grants the same permissions as the original consolidate_statements.')
+    parser.add_argument('--cases', type=int, default=2000, help='Number of statement lists to check, besides every policy file together.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for generating statement lists.')
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    failures = 0
+    checked = 0
+    narrowed = 0
+    for statements, blocks in generate_cases(rng, load_policies(), args.cases):
+        checked += 1
+        problems, case_narrowed = check_consolidation(statements, blocks)
+        narrowed += case_narrowed
+        if problems:
+            failures += 1
+            if failures <= 5:
+                print('Case ' + str(checked) + ': ' + '; '.join(problems))
+                print(json.dumps(statements))
+    print('Checked ' + str(checked) + ' statement lists, ' + str(failures) + ' failed. Merging blocks dropped cross scope grants in ' + str(narrowed) + '.')
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()